@@ -16,7 +16,7 @@ import sys
 import argparse
 from datetime import datetime
 
-from xtralite import acquire, builder
+from xtralite import acquire, builder, chunker
 
 # Read arguments
 parser = argparse.ArgumentParser(
@@ -25,7 +25,7 @@ parser = argparse.ArgumentParser(
     formatter_class=argparse.ArgumentDefaultsHelpFormatter,
 )
 parser.add_argument('name', help='name of products to build ' +
-    '(see list below)')
+    '(see list below); separate several with commas to build them together')
 parser.add_argument('--beg', help='begin date (default: %(default)s)',
     default='1980-01-01')
 parser.add_argument('--end', help='end date (default: %(default)s)',
@@ -34,8 +34,22 @@ parser.add_argument('--codas', help='prepare for codas (default: false)',
     action='store_true')
 parser.add_argument('--repro', help='reprocess/overwrite (default: false)',
     action='store_true')
+parser.add_argument('--rechunk', help='chunk existing daily files without ' +
+    'acquiring, using --jobs days at once (default: false)',
+    action='store_true')
 parser.add_argument('--head', help='head data directory (default: data)')
+parser.add_argument('--inmem', help='chunk in memory without temporary ' +
+    'files (default: false)', action='store_true')
+parser.add_argument('--windows', help='chunk windows as comma-separated ' +
+    'length:offset pairs in hours (default: %(default)s)',
+    default=chunker.WINDEF)
 parser.add_argument('--log', help='log file (default: stdout)')
+parser.add_argument('--jobs', help='number of days to acquire in parallel ' +
+    '(from each server with several products) (default: %(default)s)',
+    type=int, default=1)
+parser.add_argument('--depth', help='number of days each stage (acquire, ' +
+    'translate, chunk) can run ahead of the next (default: %(default)s)',
+    type=int, default=0)
 
 def main():
     xlargs = vars(parser.parse_args())
@@ -21,6 +21,7 @@ import netCDF4
 # stop xarray from recasting coordinates
 #import xarray as xr
 from xtralite.patches import xarray as xr
+from xtralite.acquire import fetch, listing
 
 SERVE = 'https://oco2.gesdisc.eosdis.nasa.gov/data'
 
@@ -81,19 +82,15 @@ def setup(jdnow, **xlargs):
     xlargs['yrdigs'] = 2
     xlargs['recdim'] = 'sounding_id'
     xlargs['tname']  = 'sounding_time'
+    xlargs['granule'] = 'day'
 
     if sat[:5] == 'gosat': xlargs['translate']  = translate.gosat
     if sat[:3] == 'oco':   xlargs['translate']  = translate.oco
 
-    # Set wget arguments
-    wgargs = ['-r', '-np', '-nd', '-e', 'robots=off']
-    if not xlargs.get('repro',False):
-        wgargs = wgargs + ['-N']
-    if xlargs.get('log',None) is not None:
-        wgargs = wgargs + ['-nv', '-a', xlargs['log']]
+    # Set download arguments (get newer copies of files we have)
 #   # Forward processing is retrieved elsewhere
-#   if ver[-1] != 'f': xlargs['wgargs'] = wgargs
-    xlargs['wgargs'] = wgargs
+#   if ver[-1] != 'f': xlargs['dlargs'] = dlargs
+    xlargs['dlargs'] = fetch.dlargs(xlargs, mode='newer')
 
     return xlargs
 
@@ -204,19 +201,18 @@ def acquire(jdnow, **xlargs):
             '_L2_' + stream + '_FP.' + ver[1:])
 
     # Download and prepare lite files
-    wgargs = xlargs.get('wgargs', [])
+    dlargs = xlargs.get('dlargs', {})
     yrnow = str(jdnow.year)
     yrget = str(jdnow.year-2000).zfill(2)
     dget = yrget + str(jdnow.month).zfill(2) + str(jdnow.day).zfill(2)
     fget = '*_' + dget + '_*' + xlargs['ftail']
 
-    # Download lite files
-    pout = call(['wget', '--load-cookies', path.expanduser('~/.urs_cookies'),
-        '--save-cookies', path.expanduser('~/.urs_cookies'),
-        '--auth-no-challenge=on', '--keep-session-cookies',
-        '--content-disposition'] + wgargs +
-        [SERVE + '/' + ardir + '/' + jdnow.strftime('%Y') + '/',
-        '-A', fget, '-P', path.join(xlargs['daily'], 'Y'+yrnow)])
+    # Download lite files, finding them in the year's (cached) listing
+    # instead of crawling it every day
+    urls = listing.find(SERVE + '/' + ardir + '/' + jdnow.strftime('%Y') + '/',
+        fget, auth='earthdata')
+    fetch.download(urls, path.join(xlargs['daily'], 'Y'+yrnow),
+        auth='earthdata', **dlargs)
 
     # Prepare files
     flist = glob(path.join(xlargs['daily'], 'Y'+yrnow, fget))
@@ -15,8 +15,16 @@ Default support for xtralite
 from os import path
 from subprocess import check_call
 
+from xtralite.acquire import fetch
+
 def translate(fin, ftr):
     '''Translate input to CoDAS format'''
+    # Keep in memory if there is no output file (see chunker)
+    if ftr is None:
+        from xtralite import chunker
+        from xtralite.patches import xarray as xr
+        return chunker.finish(xr.open_dataset(fin), ftr)
+
     pout = check_call(['cp', '-f', fin, ftr])
 
     return None
@@ -71,12 +79,12 @@ def setup(jdnow, **xlargs):
     xlargs['tname']  = xlargs.get('tname',  'time')
     xlargs['translate'] = xlargs.get('translate', translate)
 
-    # May want to expand this to a download command to support curl/sftp
-    wgargs = ['-r', '-np', '-nd', '-e', 'robots=off']
-    if not xlargs.get('repro',False):
-        wgargs = wgargs + ['-nc']
-    if xlargs.get('log',None) is not None:
-        wgargs = wgargs + ['-nv', '-a', xlargs['log']]
-    xlargs['wgargs'] = wgargs
+    # Remote files hold a day each unless the module says otherwise (see
+    # builder.GRANULES); each is acquired once however many days it has
+    xlargs['granule'] = xlargs.get('granule', 'day')
+
+    # Download arguments (see fetch); files already here are skipped
+    # without asking the server unless reprocessing
+    xlargs['dlargs'] = fetch.dlargs(xlargs)
 
     return xlargs
@@ -12,10 +12,16 @@ European GHG (SCIAMACHY, GOSAT, etc.) product support for xtralite
 #===============================================================================
 
 import sys
-from os import path, makedirs
-from subprocess import call
+from os import path
 from datetime import datetime, timedelta
 
+from xtralite.acquire import fetch, listing
+
+# Sometimes one works and not the other; no idea why
+SERVE = 'https://data.ceda.ac.uk/neodc'
+#SERVE = 'https://dap.ceda.ac.uk/neodc'
+SERVEIUP = 'https://www.iup.uni-bremen.de/~ghguser'
+
 # leic(ester), uol, and ocpr are different names for same thing
 modlist  = ['besd', 'wfmd', 'imap', 'ocpr', 'leic', 'uol']
 varlist  = ['co2', 'ch4', 'ch4-swpr']
@@ -46,10 +52,14 @@ def setup(jdnow, **xlargs):
 
     return xlargs
 
+def server(**xlargs):
+    '''Server the product comes from (see builder.schedule)'''
+    if xlargs.get('mod', '*').lower() == 'iup': return SERVEIUP
+
+    return SERVE
+
 def acquire(jdnow, **xlargs):
-    # Sometimes one works and not the other; no idea why
-    SERVE = 'https://data.ceda.ac.uk/neodc'
-#   SERVE = 'https://dap.ceda.ac.uk/neodc'
+    serve = server(**xlargs)
 
     # Get retrieval arguments
     mod = xlargs.get('mod', '*')
@@ -121,7 +131,6 @@ def acquire(jdnow, **xlargs):
         if satlo not in ['gosat', 'gosat2']:
             sys.stderr.write('*** ERROR *** IUP retrieval only ' +
                 'available for GOSAT & GOSAT2\n')
-        SERVE = 'https://www.iup.uni-bremen.de/~ghguser'
         if satlo == 'gosat':
             ver = 'v3.0f'
         elif satlo == 'gosat2':
@@ -145,13 +154,12 @@ def acquire(jdnow, **xlargs):
     xlargs['chunk'] = '_chunks'.join(chops)
 
     # Download
-    wgargs = xlargs.get('wgargs', None)
+    dlargs = xlargs.get('dlargs', {})
     yrget = jdnow.strftime('%Y')
     moget = jdnow.strftime('%m')
     dget = jdnow.strftime('%Y%m%d')
     fget = '*-' + dget + '-*' + xlargs['ftail']
 
-    # Might be nice to switch to cURL for everything
     if modlo == 'iup':
         # Best I could do: servers and usernames are the same
         if satlo == 'gosat':
@@ -160,15 +168,16 @@ def acquire(jdnow, **xlargs):
             fnrc = path.expanduser('~/.netrc')
 
         outdir = path.join(xlargs['daily'], 'Y'+yrget)
-        makedirs(outdir, exist_ok=True)
 
         fname = fhead + dget + '-' + ver[:-1] + '_NRT' + xlargs['ftail']
-        pout = call(['curl', '--fail', '--netrc-file', fnrc,
-            (SERVE + '/' + ardir + '/' + yrget + '/' + moget + '/' + fname),
-            '--output', path.join(outdir, fname)])
+        fetch.get(serve + '/' + ardir + '/' + yrget + '/' + moget + '/' +
+            fname, path.join(outdir, fname), auth='netrc', fnetrc=fnrc,
+            **dlargs)
     else:
-        pout = call(['wget', '--no-check-certificate'] + wgargs +
-            [SERVE + '/' + ardir + '/' + yrget + '/', '-A', fget,
-            '-P', path.join(xlargs['daily'], 'Y'+yrget)])
+        # Find the day's files in the year's (cached) listing
+        urls = listing.find(serve + '/' + ardir + '/' + yrget + '/', fget,
+            verify=False)
+        fetch.download(urls, path.join(xlargs['daily'], 'Y'+yrget),
+            verify=False, **dlargs)
 
     return xlargs
@@ -0,0 +1,566 @@
+'''
+HTTP downloads for xtralite acquirers
+'''
+# Copyright 2026 Brad Weir <briardew@gmail.com>. All rights reserved.
+# Licensed under the Apache License 2.0, which can be obtained at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Changelog:
+# 2026-10-17	Initial commit
+#
+# Todo:
+#===============================================================================
+
+import io
+import sys
+import json
+import random
+import hashlib
+import threading
+from os import path, makedirs, replace, remove, utime, getenv, getpid
+from time import time, sleep
+from netrc import netrc, NetrcParseError
+from subprocess import call
+from http.cookiejar import MozillaCookieJar, LoadError
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import urlsplit, unquote
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from urllib3.exceptions import HTTPError as Urllib3Error
+
+VERBOSE  = True
+EDLHOST  = 'urs.earthdata.nasa.gov'	# Earthdata login
+EDLCOOK  = '~/.urs_cookies'		# ... and its cookies (shared with wget)
+EDLTOKEN = 'EARTHDATA_TOKEN'		# ... or a token in this env variable
+HOSTJOBS = 4				# downloads at once from any one host
+MAXJOBS  = 16				# downloads at once in all
+MAXTRIES = 5				# tries before giving up on a file
+BACKOFF  = 2.				# first wait between tries (seconds)
+MAXWAIT  = 120.				# longest wait between tries (seconds)
+TIMEOUT  = (30, 300)			# connect and read timeouts (seconds)
+BLOCKSIZE = 2**20			# bytes written at a time
+RETRYON  = [408, 425, 429, 500, 502, 503, 504]
+
+# What to do with files that are already here: skip them without asking
+# (like wget -nc), download them again only if the server's copy changed
+# (see _unchanged), or always download them (reprocessing)
+MODES = ['skip', 'newer', 'always']
+
+# Validators (ETag, Last-Modified, and size) of downloaded files, one small
+# file for each, so later runs can ask for files only if they've changed
+METADIR = path.join(getenv('XDG_CACHE_HOME',
+    path.join(path.expanduser('~'), '.cache')), 'xtralite', 'downloads')
+
+# Sessions (one per host and authentication), host limits, and transfer
+# statistics shared by everything in this process
+SESSIONS = {}
+LOCK     = threading.Lock()
+LIMITS   = {}
+STATS    = {}
+
+class _EarthdataSession(requests.Session):
+    '''Session that sends credentials (edl) only to Earthdata login, which
+    data servers redirect to'''
+    edl = None
+
+    def rebuild_auth(self, prepared, response):
+        prepared.headers.pop('Authorization', None)
+        if urlsplit(prepared.url).hostname == EDLHOST and self.edl is not None:
+            prepared.prepare_auth(self.edl)
+
+def _creds(host, fnetrc=None):
+    '''Login and password for host from a netrc file (None if missing)'''
+    try:
+        found = netrc(fnetrc).authenticators(host)
+    except (OSError, NetrcParseError):
+        found = None
+    if found is None: return None
+
+    return (found[0], found[2])
+
+def _session(host, auth=None, fnetrc=None, token=None, verify=True):
+    '''Session for a host with the given authentication, kept for the life
+    of the process so connections and logins are reused from one file (and
+    day) to the next; threads share it (urllib3 pools connections safely)
+
+    auth is one of None (anonymous), 'earthdata' (Earthdata login via netrc,
+    cookies, or EARTHDATA_TOKEN), 'netrc' (basic authentication from
+    fnetrc), 'bearer' (token), or a requests auth object (e.g., a token
+    that is refreshed when it expires)'''
+    key = (host, auth, fnetrc, token, verify)
+    with LOCK:
+        if key in SESSIONS: return SESSIONS[key]
+
+    if auth == 'earthdata' and (token or getenv(EDLTOKEN)) is None:
+        session = _EarthdataSession()
+        session.edl = _creds(EDLHOST, fnetrc)
+        jar = MozillaCookieJar(path.expanduser(EDLCOOK))
+        try:
+            jar.load(ignore_discard=True, ignore_expires=True)
+            session.cookies.update(jar)
+        except (OSError, LoadError):
+            pass
+    else:
+        session = requests.Session()
+        if auth == 'earthdata': token = token or getenv(EDLTOKEN)
+        if auth == 'netrc': session.auth = _creds(host, fnetrc)
+        if isinstance(auth, requests.auth.AuthBase): session.auth = auth
+
+    # Enough connections for every download we allow at once
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=HOSTJOBS)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    if token is not None:
+        session.headers['Authorization'] = 'Bearer ' + token
+
+    session.verify = verify
+    if not verify:
+        from urllib3 import disable_warnings
+        from urllib3.exceptions import InsecureRequestWarning
+        disable_warnings(InsecureRequestWarning)
+
+    with LOCK:
+        return SESSIONS.setdefault(key, session)
+
+def _limit(host):
+    '''Semaphore bounding downloads from a host'''
+    with LOCK:
+        if host not in LIMITS:
+            LIMITS[host] = threading.BoundedSemaphore(HOSTJOBS)
+            STATS[host] = {'files':0, 'bytes':0, 'seconds':0., 'retries':0,
+                'failed':0}
+        return LIMITS[host]
+
+def _count(host, **kwargs):
+    '''Add to the transfer statistics for host'''
+    with LOCK:
+        for kk, vv in kwargs.items():
+            STATS[host][kk] = STATS[host][kk] + vv
+
+def _log(msg, log=None):
+    if VERBOSE: print(msg, flush=True)
+    if log is None: return
+
+    with LOCK, open(log, 'a') as fid:
+        fid.write(msg + '\n')
+
+def _wait(ntry, response=None):
+    '''Seconds to wait before trying again: exponential backoff with jitter
+    (so workers that failed together don't retry together), or whatever the
+    server asks for'''
+    if response is not None:
+        after = response.headers.get('Retry-After', '')
+        if after.isdigit(): return min(float(after), MAXWAIT)
+
+    return min(BACKOFF * 2**ntry, MAXWAIT) * random.uniform(0.5, 1.5)
+
+def _retry(host, url, fn):
+    '''Call fn() until it works, a bounded number of times, waiting longer
+    between tries; fn raises requests exceptions on failure'''
+    for ntry in range(MAXTRIES):
+        try:
+            return fn()
+        except requests.HTTPError as err:
+            # Errors like 404 won't go away
+            if err.response.status_code not in RETRYON: raise
+            wait = _wait(ntry, err.response)
+            error = err
+        except (requests.ConnectionError, requests.Timeout,
+            requests.exceptions.ChunkedEncodingError) as err:
+            wait = _wait(ntry)
+            error = err
+
+        if ntry + 1 < MAXTRIES:
+            _count(host, retries=1)
+            sleep(wait)
+
+    raise error
+
+def _metafile(fout):
+    return path.join(METADIR,
+        hashlib.sha1(path.abspath(fout).encode('utf-8')).hexdigest() + '.json')
+
+def _readmeta(fout):
+    '''Validators recorded for fout (empty if there are none)'''
+    try:
+        with open(_metafile(fout)) as fid:
+            return json.load(fid)
+    except (OSError, ValueError):
+        return {}
+
+def _length(response):
+    '''Full length of the file a response is about, or None if unknown'''
+    nlen = response.headers.get('Content-Range', '').rpartition('/')[2]
+    if not nlen.isdigit() and response.status_code == 200:
+        nlen = response.headers.get('Content-Length', '')
+
+    return int(nlen) if nlen.isdigit() else None
+
+def _writemeta(fout, url, response, meta=None):
+    '''Record the validators for fout from the response it came from,
+    keeping those in meta that the response leaves out (e.g., a 304)'''
+    meta = meta or {}
+    nlen = _length(response)
+    meta = {'url':url,
+        'etag':response.headers.get('ETag', meta.get('etag', None)),
+        'modified':response.headers.get('Last-Modified',
+            meta.get('modified', None)),
+        'length':nlen if nlen is not None else meta.get('length', None),
+        'size':path.getsize(fout) if path.isfile(fout) else None}
+
+    # Written whole and moved into place since other processes may be
+    # reading it
+    fmeta = _metafile(fout)
+    ftmp  = fmeta + '.' + str(getpid()) + '.' + str(threading.get_ident())
+    try:
+        makedirs(METADIR, exist_ok=True)
+        with open(ftmp, 'w') as fid:
+            json.dump(meta, fid)
+        replace(ftmp, fmeta)
+    except OSError:
+        pass
+
+def _complete(response, ftmp, part):
+    '''Whether a partial download the server says is finished (416) is
+    the whole of the file it has now'''
+    nlen = _length(response)
+    if nlen is None: nlen = part.get('length', None)
+    if nlen is None or nlen != path.getsize(ftmp): return False
+
+    for key, name in [('etag', 'ETag'), ('modified', 'Last-Modified')]:
+        have = response.headers.get(name, None)
+        if have is not None and part.get(key, have) != have: return False
+
+    return True
+
+def _validators(meta, fout):
+    '''Conditional request headers for our copy of a file'''
+    headers = {}
+    if meta.get('etag', None) is not None:
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('modified', None) is not None:
+        headers['If-Modified-Since'] = meta['modified']
+    else:
+        headers['If-Modified-Since'] = formatdate(path.getmtime(fout),
+            usegmt=True)
+
+    return headers
+
+def _unchanged(response, fout, meta):
+    '''Whether a full response (200) describes the copy we have, for
+    HEAD requests and servers that ignore conditional requests'''
+    etag = response.headers.get('ETag', None)
+    if etag is not None and meta.get('etag', None) is not None:
+        return etag == meta['etag']
+
+    # Anything else needs the same size
+    nlen = response.headers.get('Content-Length', '')
+    if not nlen.isdigit() or int(nlen) != path.getsize(fout): return False
+
+    modified = response.headers.get('Last-Modified', None)
+    if modified is None:
+        # Servers without timestamps (MOPITT): no clobber
+        return True
+    if meta.get('modified', None) is not None:
+        return modified == meta['modified']
+
+    # Copies from before the store (or wget): like wget -N, not newer
+    try:
+        return parsedate_to_datetime(modified).timestamp() <= \
+            path.getmtime(fout)
+    except (TypeError, ValueError):
+        return False
+
+def _stream(session, url, fout, mode):
+    '''One try at downloading url to fout, resuming a partial download if
+    there is one; returns the number of bytes transferred'''
+    ftmp = fout + '.part'
+    headers = {}
+
+    # Only get files the server has changed since our copy
+    meta = None
+    if mode == 'newer' and path.isfile(fout):
+        # Validators for something else (e.g., edited since) don't count
+        meta = _readmeta(fout)
+        if meta.get('size', None) != path.getsize(fout): meta = {}
+        headers.update(_validators(meta, fout))
+
+    # Resume only if the file hasn't changed since we started it (weak
+    # ETags can't be used for this)
+    nbeg = path.getsize(ftmp) if path.isfile(ftmp) else 0
+    part = {}
+    if 0 < nbeg:
+        headers['Range'] = 'bytes=%d-' % nbeg
+        part = _readmeta(ftmp)
+        etag = part.get('etag', None)
+        if etag is not None and not etag.startswith('W/'):
+            headers['If-Range'] = etag
+        elif part.get('modified', None) is not None:
+            headers['If-Range'] = part['modified']
+
+    # Ask about files we have without a body, since some servers ignore
+    # conditional requests; those that don't answer HEAD get a conditional
+    # GET (and the same check) below
+    if meta is not None:
+        with session.head(url, headers=headers, allow_redirects=True,
+            timeout=TIMEOUT) as response:
+            if response.status_code == 304 or (response.status_code == 200
+                and _unchanged(response, fout, meta)):
+                _writemeta(fout, url, response, meta)
+                return 0
+
+    nget = 0
+    with session.get(url, headers=headers, stream=True,
+        timeout=TIMEOUT) as response:
+        # Not changed; closing the response skips the body
+        if response.status_code == 304 or (meta is not None and
+            response.status_code == 200 and _unchanged(response, fout, meta)):
+            _writemeta(fout, url, response, meta)
+            return 0
+
+        # 416 means the partial download is already complete, as long as
+        # it matches the file on the server; if not, start over
+        done  = response.status_code == 416 and 0 < nbeg
+        stale = done and not _complete(response, ftmp, part)
+        if not done:
+            response.raise_for_status()
+
+            # Start over if the server ignored the range
+            if response.status_code != 206: nbeg, part = 0, {}
+            if nbeg == 0: _writemeta(ftmp, url, response)
+            with open(ftmp, 'ab' if 0 < nbeg else 'wb') as fid:
+                for block in response.iter_content(BLOCKSIZE):
+                    fid.write(block)
+                    nget = nget + len(block)
+
+            # Truncated responses are retried (and resumed)
+            nlen = response.headers.get('Content-Length', '')
+            if nlen.isdigit() and nget < int(nlen):
+                raise requests.exceptions.ChunkedEncodingError('Got ' +
+                    '%d of %s bytes' % (nget, nlen))
+
+        modified = response.headers.get('Last-Modified',
+            part.get('modified', None))
+
+    if stale:
+        remove(ftmp)
+        try:
+            remove(_metafile(ftmp))
+        except OSError:
+            pass
+        return _stream(session, url, fout, mode)
+
+    replace(ftmp, fout)
+    _writemeta(fout, url, response, part)
+    try:
+        remove(_metafile(ftmp))
+    except OSError:
+        pass
+
+    # Keep the server's timestamp like wget does so newer checks work
+    if modified is not None:
+        try:
+            mtime = parsedate_to_datetime(modified).timestamp()
+            utime(fout, (mtime, mtime))
+        except (TypeError, ValueError):
+            pass
+
+    return nget
+
+def get(url, fout, mode='newer', auth=None, fnetrc=None, token=None,
+    verify=True, log=None):
+    '''Download url to fout, returning fout or None if it failed'''
+    if mode == 'skip' and path.isfile(fout): return fout
+
+    parts = urlsplit(url)
+    host  = parts.hostname
+    makedirs(path.dirname(fout) or '.', exist_ok=True)
+
+    # Everything but http(s) (e.g., sftp) is handed to curl; there are no
+    # validators, so files already here are kept unless always downloading
+    if parts.scheme not in ['http', 'https']:
+        if mode != 'always' and path.isfile(fout): return fout
+
+        ftmp = fout + '.part'
+        cmd = ['curl', '--fail', '--create-dirs', '-C', '-', '-o', ftmp, url]
+        if auth == 'netrc':
+            cmd[1:1] = ['--netrc'] if fnetrc is None else ['--netrc-file',
+                fnetrc]
+        if call(cmd) != 0: return None
+
+        replace(ftmp, fout)
+        return fout
+
+    session = _session(host, auth, fnetrc, token, verify)
+    with _limit(host):
+        tbeg = time()
+        try:
+            nget = _retry(host, url,
+                lambda: _stream(session, url, fout, mode))
+        except (requests.RequestException, OSError) as err:
+            _count(host, failed=1)
+            sys.stderr.write('*** WARNING *** Failed to download %s (%s)\n\n'
+                % (url, repr(err)))
+            return None
+        secs = time() - tbeg
+
+    _count(host, files=1, bytes=nget, seconds=secs)
+    if nget == 0:
+        _log('* Unchanged   ' + path.basename(fout), log)
+    else:
+        _log('* Downloaded  %s (%.1f MB in %.1f s, %.1f MB/s)' %
+            (path.basename(fout), nget/1e6, secs, nget/1e6/max(secs, 1e-3)),
+            log)
+
+    return fout
+
+def download(urls, dirout, jobs=None, **kwargs):
+    '''Download urls into dirout (named like the urls), several at a time
+    but no more than HOSTJOBS from any host; returns the files we have'''
+    fouts = [path.join(dirout, unquote(urlsplit(uu).path.rsplit('/', 1)[-1]))
+        for uu in urls]
+    if len(urls) == 0: return []
+
+    makedirs(dirout, exist_ok=True)
+    if len(urls) == 1:
+        got = [get(urls[0], fouts[0], **kwargs)]
+    else:
+        nproc = min(jobs or MAXJOBS, len(urls))
+        with ThreadPoolExecutor(max_workers=nproc) as pool:
+            got = list(pool.map(lambda uf: get(uf[0], uf[1], **kwargs),
+                zip(urls, fouts)))
+
+    return [ff for ff in got if ff is not None]
+
+class _Stream(io.RawIOBase):
+    '''Remote file read as it arrives, picking up where it left off (with a
+    range request) if the connection drops'''
+    def __init__(self, session, host, url):
+        self.session = session
+        self.host = host
+        self.url  = url
+        self.nget = 0
+        self.nlen = -1
+        self.ntry = 0
+        self.tbeg = time()
+        self.response = None
+        self.validator = None
+
+        self.limit = _limit(host)
+        self.limit.acquire()
+        try:
+            self._open()
+        except BaseException:
+            self.limit.release()
+            raise
+
+    def _open(self):
+        headers = {}
+        if 0 < self.nget:
+            headers['Range'] = 'bytes=%d-' % self.nget
+            if self.validator is not None:
+                headers['If-Range'] = self.validator
+
+        def _get():
+            response = self.session.get(self.url, headers=headers,
+                stream=True, timeout=TIMEOUT)
+            try:
+                response.raise_for_status()
+            except requests.HTTPError:
+                response.close()
+                raise
+            return response
+
+        response = _retry(self.host, self.url, _get)
+
+        # Can't splice in a file that changed (or a server that ignored
+        # the range)
+        if 0 < self.nget and response.status_code != 206:
+            response.close()
+            raise OSError('Unable to resume %s at byte %d' %
+                (self.url, self.nget))
+
+        # Expected length so truncation isn't mistaken for the end
+        nlen = response.headers.get('Content-Length', '')
+        if nlen.isdigit(): self.nlen = self.nget + int(nlen)
+
+        etag = response.headers.get('ETag', None)
+        if etag is not None and etag.startswith('W/'): etag = None
+        self.validator = etag or response.headers.get('Last-Modified', None)
+        self.response = response
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while True:
+            try:
+                data = self.response.raw.read(len(buf), decode_content=True)
+                if len(data) == 0 and self.nget < self.nlen:
+                    raise OSError('Got %d of %d bytes' % (self.nget, self.nlen))
+                break
+            except (Urllib3Error, requests.RequestException, OSError) as err:
+                self.ntry = self.ntry + 1
+                if MAXTRIES <= self.ntry:
+                    raise OSError('Failed reading %s (%s)' %
+                        (self.url, repr(err)))
+                _count(self.host, retries=1)
+                self.response.close()
+                sleep(_wait(self.ntry))
+                self._open()
+
+        buf[:len(data)] = data
+        self.nget = self.nget + len(data)
+        return len(data)
+
+    def close(self):
+        if self.closed: return
+        if self.response is not None: self.response.close()
+        self.limit.release()
+        _count(self.host, files=1, bytes=self.nget, seconds=time()-self.tbeg)
+        super().close()
+
+def stream(url, auth=None, fnetrc=None, token=None, verify=True):
+    '''Remote file as a binary file object to read as it arrives (e.g., with
+    tarfile mode r|), resumed if the connection drops; None if it can't be
+    had'''
+    host = urlsplit(url).hostname
+    session = _session(host, auth, fnetrc, token, verify)
+    try:
+        raw = _Stream(session, host, url)
+    except (requests.RequestException, OSError) as err:
+        _count(host, failed=1)
+        sys.stderr.write('*** WARNING *** Failed to download %s (%s)\n\n'
+            % (url, repr(err)))
+        return None
+
+    return io.BufferedReader(raw, BLOCKSIZE)
+
+def text(url, auth=None, fnetrc=None, token=None, verify=True):
+    '''Contents of url as text (e.g., a directory index), or None if it
+    can't be had'''
+    host = urlsplit(url).hostname
+    session = _session(host, auth, fnetrc, token, verify)
+
+    def _text():
+        response = session.get(url, timeout=TIMEOUT)
+        response.raise_for_status()
+        return response.text
+
+    with _limit(host):
+        try:
+            return _retry(host, url, _text)
+        except requests.RequestException as err:
+            sys.stderr.write('*** WARNING *** Unable to get %s (%s)\n\n' %
+                (url, repr(err)))
+            return None
+
+def dlargs(xlargs, mode='skip'):
+    '''Download mode and log from runtime arguments (reprocessing always
+    downloads); files already here are skipped (like wget -nc) unless the
+    module asks for newer copies (like wget -N)'''
+    if xlargs.get('repro',False): mode = 'always'
+
+    return {'mode':mode, 'log':xlargs.get('log',None)}
@@ -13,9 +13,10 @@ IASI support for xtralite
 
 import sys
 from os import path
-from subprocess import call
 from datetime import datetime, timedelta
 
+from xtralite.acquire import fetch
+
 #SERVE = 'https://cds-espri.ipsl.fr'
 SERVE = 'https://thredds-su.ipsl.fr'
 # HNO3 and other NRT products available from Eumetcast
@@ -112,7 +113,7 @@ def setup(jdnow, **xlargs):
 #       'iasi_' + var.lower() + '/' + verin)
     xlargs['ardir'] = ('thredds/fileServer/IASI/L2/' + var.upper() + '/METOP-' +
         sat[-1].upper() + '_2')
-    xlargs['wgargs'] = ['-N', '-c']
+    xlargs['dlargs'] = fetch.dlargs(xlargs, mode='newer')
 
     if '*' not in var: xlargs['translate'] = translate[var.lower()]
 
@@ -123,15 +124,14 @@ def acquire(jdnow, **xlargs):
     xlargs = setup(jdnow, **xlargs)
     fget  = xlargs['fget']
     ardir = xlargs['ardir']
-    wgargs = xlargs.get('wgargs', None)
+    dlargs = xlargs.get('dlargs', {})
 
     # Download
     yrnow = str(jdnow.year)
 
     # Download daily files
-    cmd = (['wget', '-nv', '--no-check-certificate'] + wgargs +
-        [SERVE + '/' + ardir + '/' + jdnow.strftime('%Y/%m') +
-        '/' + fget, '-P', xlargs['daily'] + '/Y' + yrnow])
-    pout = call(cmd)
+    fetch.get(SERVE + '/' + ardir + '/' + jdnow.strftime('%Y/%m') + '/' +
+        fget, path.join(xlargs['daily'], 'Y' + yrnow, fget), verify=False,
+        **dlargs)
 
     return xlargs
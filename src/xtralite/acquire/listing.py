@@ -0,0 +1,107 @@
+'''
+Remote directory listings for xtralite acquirers
+'''
+# Copyright 2026 Brad Weir <briardew@gmail.com>. All rights reserved.
+# Licensed under the Apache License 2.0, which can be obtained at
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Changelog:
+# 2026-10-17	Initial commit
+#
+# Todo:
+#===============================================================================
+
+import re
+import json
+import hashlib
+from os import path, makedirs, replace, getenv, getpid
+from time import time
+from fnmatch import fnmatchcase
+from urllib.parse import urljoin, urlsplit, unquote
+
+from xtralite.acquire import fetch
+
+CACHEDIR = path.join(getenv('XDG_CACHE_HOME',
+    path.join(path.expanduser('~'), '.cache')), 'xtralite', 'listings')
+LISTTTL = 86400				# seconds before a listing is fetched again
+MISSTTL = 3600				# ... or sooner if it's missing a file
+
+# Listings already read in this process, by url
+LISTINGS = {}
+
+HREF = re.compile(r'href\s*=\s*["\']([^"\']+)["\']', re.IGNORECASE)
+
+def _parse(html, url):
+    '''Map file names to urls for links in a directory index'''
+    files = {}
+    base  = urlsplit(url).path
+    for href in HREF.findall(html):
+        link = urljoin(url, href)
+        head, _, tail = urlsplit(link).path.rpartition('/')
+        name = unquote(tail)
+
+        # Skip directories, sort links, and anything not in this one (some
+        # archives link to files on a different host)
+        if len(name) == 0 or head + '/' != base: continue
+        if name not in files: files[name] = link
+
+    return files
+
+def _fetch(url, fcache, **kwargs):
+    '''Download and parse a directory index, returning None on failure'''
+    html = fetch.text(url, **kwargs)
+    if html is None: return None
+
+    files = _parse(html, url)
+
+    # Written whole and moved into place since other processes may be
+    # reading it
+    makedirs(CACHEDIR, exist_ok=True)
+    ftmp = fcache + '.' + str(getpid())
+    with open(ftmp, 'w') as fid:
+        json.dump({'url':url, 'files':files}, fid)
+    replace(ftmp, fcache)
+
+    return files
+
+def listing(url, maxage=LISTTTL, **kwargs):
+    '''Files in a remote directory (url) as a dictionary of urls by name,
+    fetching its index only if the cached copy is older than maxage seconds
+    (kwargs are passed on to fetch.text, e.g., for authentication)'''
+    if not url.endswith('/'): url = url + '/'
+    fcache = path.join(CACHEDIR,
+        hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    # Check this process first, then the cache on disk
+    fetched, files = LISTINGS.get(url, (None, None))
+    if files is None and path.isfile(fcache):
+        try:
+            with open(fcache) as fid:
+                files = json.load(fid)['files']
+            fetched = path.getmtime(fcache)
+        except (OSError, ValueError, KeyError):
+            files = None
+
+    if files is None or maxage < time() - fetched:
+        fnew = _fetch(url, fcache, **kwargs)
+        if fnew is not None:
+            fetched, files = time(), fnew
+        elif files is None:
+            return {}
+
+    LISTINGS[url] = (fetched, files)
+    return files
+
+def find(url, pattern, **kwargs):
+    '''Urls of files in a remote directory (url) matching a wildcard
+    pattern, using a cached listing unless it's stale or has no matches'''
+    files = listing(url, **kwargs)
+    names = [nn for nn in files if fnmatchcase(nn, pattern)]
+
+    # New files show up in directories that are still being filled, so
+    # check again if the listing isn't recent
+    if len(names) == 0:
+        files = listing(url, maxage=MISSTTL, **kwargs)
+        names = [nn for nn in files if fnmatchcase(nn, pattern)]
+
+    return [files[nn] for nn in sorted(names)]
@@ -15,9 +15,10 @@ MOPITT support for xtralite
 
 import sys
 from os import path
-from subprocess import call
 from datetime import datetime, timedelta
 
+from xtralite.acquire import fetch, listing
+
 VERBOSE = True
 DEBUG   = True
 
@@ -91,13 +92,10 @@ def acquire(jdnow, **xlargs):
     fwild = '*-' + date + '-*' + xlargs['ftail']
     ardir = 'MOP02' + var[0].upper() + '.' + ver[1:-1].zfill(3)
 
-    cmd = (['wget', '--load-cookies', path.expanduser('~/.urs_cookies'),
-        '--save-cookies', path.expanduser('~/.urs_cookies'),
-        '--auth-no-challenge=on', '--keep-session-cookies',
-        '--content-disposition'] + xlargs['wgargs'] +
-        [SERVE + '/' + ardir + '/' + jdnow.strftime('%Y.%m.%d') + '/',
-        '-A', fwild, '-P', path.join(xlargs['daily'], 'Y'+year)])
-    if VERBOSE: print(' '.join(cmd))
-    pout = call(cmd)        
+    ddir = SERVE + '/' + ardir + '/' + jdnow.strftime('%Y.%m.%d') + '/'
+    urls = listing.find(ddir, fwild, auth='earthdata')
+    if VERBOSE: print('Downloading ' + ', '.join(urls) + ' from ' + ddir)
+    fetch.download(urls, path.join(xlargs['daily'], 'Y'+year),
+        auth='earthdata', **xlargs['dlargs'])
 
     return xlargs
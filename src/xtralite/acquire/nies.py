@@ -18,11 +18,17 @@ NIES (GOSAT, GOSAT-2) support for xtralite
 # Todo:
 #===============================================================================
 
-from os import path
+import sys
+import shutil
+import tarfile
+from os import path, makedirs, replace, utime
 from glob import glob
-from subprocess import call
+from time import sleep
+from fnmatch import fnmatchcase
 from datetime import datetime, timedelta
 
+from xtralite.acquire import fetch
+
 # stop xarray from recasting coordinates
 #import xarray as xr
 from xtralite.patches import xarray as xr
@@ -35,9 +41,15 @@ satlist = ['gosat', 'gosat2']
 satday0 = [datetime(2009, 4, 1), datetime(2019, 3, 1)]
 namelist = ['nies_' + vv for vv in varlist]
 
-RMTAR = True		# Remove tar files?
+BLOCKSIZE = 2**20	# bytes written at a time from tar files
+
+def server(**xlargs):
+    '''Server the product comes from (see builder.schedule)'''
+    if xlargs.get('sat', '*') == 'gosat2': return SERVE2
+
+    return SERVE1
 
-def setup(**xlargs):
+def setup(jdnow, **xlargs):
     from xtralite.acquire import default
 #   from xtralite.translate.nies import translate
 
@@ -45,10 +57,9 @@ def setup(**xlargs):
     xlargs['ftail'] = 'h5'
 #   xlargs['translate'] = translate
 
-    xlargs = default.setup(**xlargs)
+    xlargs = default.setup(jdnow, **xlargs)
 
     # Time-specific variables
-    jdnow = xlargs['jdbeg']
     yrget = str(jdnow.year)
     if xlargs['sat'] == 'gosat':
         dget = jdnow.strftime('%Y%m')
@@ -73,6 +84,7 @@ def setup(**xlargs):
         ardir = SERVE1 + '/wgetdata/GU/' + tag + '/' + yrget
 
         xlargs['fhead'] = 'GOSATTFTS'
+        xlargs['granule'] = 'month'
 
     elif xlargs['sat'] == 'gosat2':
         dget = jdnow.strftime('%Y%m%d')
@@ -103,6 +115,7 @@ def setup(**xlargs):
         ardir = SERVE2 + '/' + ardir
 
         xlargs['fhead'] = 'GOSAT2TFTS2'
+        xlargs['granule'] = 'day'
 
     xlargs['ver'] = ver
     xlargs['daily'] = path.join(xlargs['head'], 'nies', xlargs['var'],
@@ -114,38 +127,76 @@ def setup(**xlargs):
 
     return xlargs
 
-def acquire(**xlargs):
-    # Determine timespan
-    jdbeg = xlargs.get('jdbeg', min(satday0))
+def _extract(url, dout, patterns):
+    '''Stream a tar file from url, writing the members whose names match
+    any of patterns to dout (without their directories); returns how many
+    were written, or None if it failed partway (or couldn't start)'''
+    fin = fetch.stream(url, auth='netrc')
+    if fin is None: return None
+
+    makedirs(dout, exist_ok=True)
+    nout = 0
+    try:
+        with fin, tarfile.open(fileobj=fin, mode='r|') as tar:
+            for member in tar:
+                name = path.basename(member.name)
+                if not member.isfile() or not any(fnmatchcase(name, pp)
+                    for pp in patterns): continue
+
+                # Written whole and moved into place so an interrupted
+                # extraction doesn't look like a complete day
+                fout = path.join(dout, name)
+                with tar.extractfile(member) as fsrc, \
+                    open(fout + '.part', 'wb') as fdst:
+                    shutil.copyfileobj(fsrc, fdst, BLOCKSIZE)
+                replace(fout + '.part', fout)
+                utime(fout, (member.mtime, member.mtime))
+                nout = nout + 1
+    except (OSError, tarfile.TarError) as err:
+        sys.stderr.write('*** WARNING *** Failed to extract %s (%s)\n\n' %
+            (url, repr(err)))
+        return None
+
+    return nout
+
+def acquire(jdnow, **xlargs):
+    xlargs = setup(jdnow, **xlargs)
+    fget  = xlargs['fget']
+    ardir = xlargs['ardir']
+    dlargs = xlargs.get('dlargs', {})
+
+    # Days in this granule (the rest of the month for GOSAT) that are
+    # requested and missing
     jdend = xlargs.get('jdend', datetime.now())
-    ndays = (jdend - jdbeg).days + 1
-
-    wgargs = xlargs.get('wgargs', None)
-
-    # Download lite files
-    xlnow = dict(xlargs)
-    for nd in range(ndays):
-        jdnow = xlargs['jdbeg'] + timedelta(nd)
-        xlnow['jdbeg'] = jdnow
-        xlnow = setup(**xlnow)
-
-        fget = xlnow['fget']
-        ardir = xlnow['ardir']
-
-        dout = path.join(xlargs['daily'], 'Y'+str(jdnow.year))
-        fout = path.join(dout, fget)
-        fday = path.join(dout, xlargs['fhead'] + jdnow.strftime('%Y%m%d') +
-            '_*.' + xlargs['ftail'])
-
-        if len(glob(fday)) != 0 and not xlargs.get('repro',False):
-            continue
-
-        pout = call(['curl', '--netrc', '--create-dirs', '-C', '-',
-            '-o', fout, ardir + '/' + fget])
-
-        if xlnow['sat'] == 'gosat':
-            pout = call(['tar', 'xf', fout, '--strip-components=1',
-                '-C', dout])
-            if RMTAR: pout = call(['rm', fout])
+    days = [jdnow]
+    if xlargs['granule'] == 'month':
+        while (days[-1] + timedelta(1)).month == jdnow.month and \
+            days[-1] + timedelta(1) <= jdend:
+            days.append(days[-1] + timedelta(1))
+
+    dout = path.join(xlargs['daily'], 'Y'+str(jdnow.year))
+    fdays = [xlargs['fhead'] + jd.strftime('%Y%m%d') + '_*.' + xlargs['ftail']
+        for jd in days]
+    if not xlargs.get('repro',False):
+        fdays = [ff for ff in fdays if len(glob(path.join(dout, ff))) == 0]
+    if len(fdays) == 0: return xlargs
+
+    # GOSAT tar files hold a month; they're read as they download, keeping
+    # only the days we need, so the tar file itself never touches disk.
+    # Failures are tried again for the days still missing, and the month
+    # fails if they can't be had (days not in the tar aren't retried)
+    if xlargs['sat'] == 'gosat':
+        for ntry in range(fetch.MAXTRIES):
+            if _extract(ardir + '/' + fget, dout, fdays) is not None:
+                return xlargs
+            fdays = [ff for ff in fdays if len(glob(path.join(dout, ff))) == 0]
+            if len(fdays) == 0: return xlargs
+            if ntry + 1 < fetch.MAXTRIES: sleep(fetch._wait(ntry))
+
+        raise OSError('Failed to extract %d day(s) from %s' %
+            (len(fdays), fget))
+
+    fetch.get(ardir + '/' + fget, path.join(dout, fget), auth='netrc',
+        **dlargs)
 
     return xlargs
@@ -12,9 +12,9 @@ TROPESS (AIRS, CrIS) support for xtralite
 #===============================================================================
 
 import sys
-from os import path
-from subprocess import call
-from datetime import datetime, timedelta
+from datetime import datetime
+
+from xtralite.acquire import fetch, listing
 
 SERVE = 'https://tropess.gesdisc.eosdis.nasa.gov/data/TROPESS_Standard'
 
@@ -26,7 +26,7 @@ satlist = ['airs', 'cris-s', 'cris-1']
 satday0 = [datetime(2021, 1, 1), datetime(2021, 1, 1), datetime(2021, 1, 1)]
 namelist = ['tropess_' + vv for vv in varlist]
 
-def setup(**xlargs):
+def setup(jdnow, **xlargs):
     from xtralite.acquire import default
     from xtralite.translate.tropess import translate
 
@@ -35,11 +35,11 @@ def setup(**xlargs):
 
     xlargs['translate'] = translate
 
-    xlargs = default.setup(**xlargs)
+    xlargs = default.setup(jdnow, **xlargs)
 
     return xlargs
 
-def acquire(**xlargs):
+def acquire(jdnow, **xlargs):
 #   Get retrieval arguments
     mod = xlargs.get('mod', '*')
     var = xlargs.get('var', '*')
@@ -65,24 +65,15 @@ def acquire(**xlargs):
     xlargs['fhead'] = fhead
     xlargs['fhout'] = mod + '_' + var + '_' + sat + '_' + ver + '.'
 
-#   Determine timespan
-    jdbeg = xlargs.get('jdbeg', min(satday0))
-    jdend = xlargs.get('jdend', datetime.now())
-    ndays = (jdend - jdbeg).days + 1
-
-#   Download
-    wgargs = xlargs.get('wgargs', None)
-    for nd in range(ndays):
-        jdnow = jdbeg + timedelta(nd)
-        yrnow = str(jdnow.year)
-        dget = yrnow + str(jdnow.month).zfill(2) + str(jdnow.day).zfill(2)
-        fget = '*_' + dget + '_*' + xlargs['ftail']
-
-        pout = call(['wget', '--load-cookies', path.expanduser('~/.urs_cookies'),
-            '--save-cookies', path.expanduser('~/.urs_cookies'),
-            '--auth-no-challenge=on', '--keep-session-cookies',
-            '--content-disposition'] + wgargs +
-            [SERVE + '/' + ardir + '/' + jdnow.strftime('%Y') + '/',
-            '-A', fget, '-P', xlargs['daily'] + '/Y' + yrnow])
+#   Download, finding files in the year's (cached) listing
+    dlargs = xlargs.get('dlargs', {})
+    yrnow = str(jdnow.year)
+    dget = yrnow + str(jdnow.month).zfill(2) + str(jdnow.day).zfill(2)
+    fget = '*_' + dget + '_*' + xlargs['ftail']
+
+    urls = listing.find(SERVE + '/' + ardir + '/' + jdnow.strftime('%Y') +
+        '/', fget, auth='earthdata')
+    fetch.download(urls, xlargs['daily'] + '/Y' + yrnow,
+        auth='earthdata', **dlargs)
 
     return xlargs
@@ -10,10 +10,8 @@ TROPOMI support for xtralite
 #
 # Todo:
 # * Pressure/altitude grid
-# * Only works with RMORBS on, I think because the overlapping _two files
-#   don't get updated properly
 # * Fix attributes
-# * Move to native xarray (drop NCO and netCDF4 use)
+# * Move to native xarray (drop netCDF4 use)
 #
 # Notes:
 # * CO is on a fixed altitude grid that's something like every 500 m
@@ -23,18 +21,14 @@ TROPOMI support for xtralite
 #===============================================================================
 
 import sys
-from os import path, makedirs
+from os import path, makedirs, replace, cpu_count
 from shutil import rmtree
-from subprocess import call, PIPE, Popen
 from glob import glob
-from datetime import datetime, timedelta
-from importlib.resources import files
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import netCDF4
-# stop xarray from recasting coordinates
-#import xarray as xr
-from xtralite.patches import xarray as xr
 
 VERDEF   = 'v2r'
 modname  = 'tropomi'
@@ -54,6 +48,310 @@ RMORBS = True				# remove orbit files?
 RECDIM = 'sounding'			# shares name with nsound from chunk format
 FTAIL  = '.nc'
 TIME0  = datetime(2010, 1, 1)
+NCHUNK = 4096				# soundings per chunk in daily files
+ZARGS  = {'zlib':True, 'complevel':9, 'shuffle':True}	# like ncks -L 9
+
+def _find_vars(ncf, vnames):
+    '''Find variables in the PRODUCT group (and its subgroups) of an orbit
+    file'''
+    found  = {}
+    groups = [ncf.groups['PRODUCT']]
+    while 0 < len(groups):
+        grp = groups.pop(0)
+        for vv in vnames:
+            if vv not in found and vv in grp.variables:
+                found[vv] = grp.variables[vv]
+        groups = groups + list(grp.groups.values())
+
+    missing = [vv for vv in vnames if vv not in found]
+    if 0 < len(missing):
+        raise KeyError('Missing from ' + path.basename(ncf.filepath()) +
+            ': ' + ', '.join(missing))
+
+    return found
+
+def _read_var(var, scans=slice(None)):
+    '''Read a variable over a range of scanlines, dropping the time
+    dimension'''
+    # Time dimension has length 1, so dropping it is the same as averaging
+    # over it
+    index = []
+    for dd in var.dimensions:
+        if dd == 'time':
+            index.append(0)
+        elif dd == 'scanline':
+            index.append(scans)
+        else:
+            index.append(slice(None))
+    data = var[tuple(index)]
+    dims = tuple(dd for dd in var.dimensions if dd != 'time')
+
+    return {'data':np.ma.asanyarray(data), 'dims':dims, 'dtype':var.dtype,
+        'attrs':var.__dict__}
+
+def _define(ncf, name, vin, dims=None, **kwargs):
+    '''Define a variable like one read by _read_var, creating
+    dimensions as needed'''
+    if dims is None:
+        dims = vin['dims']
+        for dd, nn in zip(dims, vin['data'].shape):
+            if dd not in ncf.dimensions: ncf.createDimension(dd, nn)
+
+    attrs = dict(vin['attrs'])
+    fill  = attrs.pop('_FillValue', None)
+    var   = ncf.createVariable(name, vin['dtype'], dims, fill_value=fill,
+        **kwargs)
+    var.setncatts(attrs)
+
+    return var
+
+def _datevec(times):
+    '''Year, month, day, hour, minute, second, and millisecond of datetime64
+    times'''
+    years  = times.astype('datetime64[Y]')
+    months = times.astype('datetime64[M]')
+    days   = times.astype('datetime64[D]')
+    secs   = times.astype('datetime64[s]')
+
+    dvec = np.zeros((times.size, 7), dtype='int64')
+    dvec[:,0] = years.astype('int64') + 1970
+    dvec[:,1] = (months - years).astype('int64') + 1
+    dvec[:,2] = (days - months).astype('int64') + 1
+    dvec[:,3] = (secs - days) // np.timedelta64(1, 'h')
+    dvec[:,4] = (secs - days) // np.timedelta64(1, 'm') % 60
+    dvec[:,5] = (secs - days) // np.timedelta64(1, 's') % 60
+    dvec[:,6] = (times - secs) // np.timedelta64(1, 'ms')
+
+    return dvec
+
+def _convert_orbit(ff, jdnow, conf):
+    '''Convert an orbit file (ff) to a dictionary of variables with just the
+    soundings we keep (run in a worker process)'''
+    dnames   = conf['dnames']
+    vnames   = conf['vnames']
+    vnames0d = conf['vnames0d']
+    vnames1d = conf['vnames1d']
+    vnames2d = conf['vnames2d']
+    LANDONLY = conf['LANDONLY']
+    QAMIN    = conf['QAMIN']
+    CLMAX    = conf['CLMAX']
+    VCLOUD   = conf['VCLOUD']
+    VCHECK   = conf['VCHECK']
+    VBLEND   = conf['VBLEND']
+    varlo    = conf['varlo']
+    ver      = conf['ver']
+
+    # Read what decides who to keep over the whole orbit, then everything
+    # else over just the scanlines with soundings we keep, so each variable
+    # is read once
+    vsel = ['time', 'delta_time', 'ground_pixel', 'qa_value',
+        'surface_classification', VCHECK]
+    if 0 < len(VCLOUD): vsel = vsel + [VCLOUD]
+
+    with netCDF4.Dataset(ff, 'r') as ncf:
+        # The blended variable is computed here, not read
+        vins  = _find_vars(ncf, [vv for vv in vnames + dnames
+            if vv != VBLEND])
+        orbit = {vv:_read_var(vins[vv]) for vv in vsel + dnames + vnames0d}
+
+        # Only copy obs with valid data in correct day (obuse)
+        # About 2% of all soundings for CH4, almost everything for others
+        obchk = orbit[VCHECK]['data']
+        time  = orbit['time']['data']
+        delt  = orbit['delta_time']['data']
+        vpix  = orbit['ground_pixel']
+        qa    = orbit['qa_value']['data']
+        stype = orbit['surface_classification']['data']
+
+        # Recall time dimension was dropped by the reader
+        nscn = np.size(obchk, axis=0)
+        npix = np.size(obchk, axis=1)
+
+        if npix != vpix['data'].size: raise
+
+        # Some annoying logic to deal with different delta_time dimensions
+        # HCHO and SO2 are unique with delta_time that has a ground_pixel
+        # dimension and missing time_utc values
+        dfix = delt.data[:,0] if (delt.shape == obchk.shape) else delt.data
+        tref = (np.datetime64(TIME0, 'ms') +
+            np.timedelta64(int(time.data[()]), 's'))
+        tscn = tref + dfix.astype('int64').astype('timedelta64[ms]')
+        tsnd = np.repeat(tscn, npix)
+        tuse = tsnd.astype('datetime64[D]') == np.datetime64(jdnow.date(), 'D')
+
+        # Decide who to keep
+        qause = ~np.less(qa, QAMIN)
+        obuse = np.logical_and(~np.ma.getmaskarray(obchk), qause)
+        obuse = obuse.reshape(obchk.size,)
+        obuse = np.logical_and(tuse, obuse)
+        mask  = (stype % 2).reshape(obchk.size,)
+
+        if LANDONLY: obuse = np.logical_and(obuse, mask == 0)
+
+        # Add cloud flags
+        if 0 < len(VCLOUD):
+            cloud = orbit[VCLOUD]['data']
+            cluse = np.less(cloud, CLMAX).reshape(obchk.size,)
+            obuse = np.logical_and(obuse, cluse)
+
+        # Skip orbits with no data
+        nsound = obuse[obuse].size
+        if nsound == 0: return {}
+
+        # Trim everything to the scanlines we need
+        scnuse = np.flatnonzero(obuse.reshape(nscn, npix).any(axis=1))
+        scans  = slice(scnuse[0], scnuse[-1] + 1)
+        for vv in vsel:
+            if 'scanline' in orbit[vv]['dims']:
+                orbit[vv]['data'] = orbit[vv]['data'][scans]
+        obuse = obuse.reshape(nscn, npix)[scans].reshape(-1)
+        tsnd  = tsnd.reshape(nscn, npix)[scans].reshape(-1)
+        nscn  = scans.stop - scans.start
+
+        for vv in vnames1d + vnames2d:
+            if vv not in orbit and vv != VBLEND:
+                orbit[vv] = _read_var(vins[vv], scans)
+
+        # Blend (Balasus et al., 2023) just the soundings we keep while the
+        # orbit is open instead of rewriting the whole orbit file
+        if 0 < len(VBLEND):
+            from xtralite.acquire import tropomi_blend
+
+            var1 = orbit[VCHECK]
+            qa1  = orbit['qa_value']['data'] == 1.0
+            mask = np.logical_and(obuse.reshape(nscn, npix), qa1)
+            orbit[VBLEND] = dict(var1,
+                attrs=dict(var1['attrs'], comment=tropomi_blend.COMMENT),
+                data=tropomi_blend.blended(ncf, var1['data'], mask,
+                tropomi_blend.load_model(conf['fmodel']), scans))
+
+    # Dimensions and constants (constants get a sounding dimension like
+    # they did when orbits were concatenated with open_mfdataset)
+    keep = {}
+    for vv in dnames:
+        keep[vv] = orbit[vv]
+    for vv in vnames0d:
+        var1 = orbit[vv]
+        keep[vv] = dict(var1, dims=(RECDIM,) + var1['dims'],
+            data=np.broadcast_to(var1['data'], (nsound,) + var1['data'].shape))
+
+    # Compute time for averaged sounding
+    tavg = tsnd[obuse]
+    dvec = _datevec(tavg)
+
+    # Date and time variables
+    keep['date'] = {'dims':(RECDIM,'ndate'), 'dtype':np.dtype('int16'),
+        'attrs':{'_FillValue':np.int16(-9999), 'units':'none',
+        'long_name':'Observation date and time matching sounding_id',
+        'comment':('Year, month (1-12), day (1-31), hour (0-23), ' +
+        'minute (0-59), second (0-59), millisecond (0-999). Note '  +
+        'this time is chosen to correspond exactly to the digits '  +
+        'in sounding_id')}, 'data':dvec}
+
+    # NB: This has always been seconds since midnight, not since TIME0
+    # (it was computed as timedelta.seconds); translate doesn't use it
+    keep['time'] = {'dims':(RECDIM,), 'dtype':np.dtype('float64'),
+        'attrs':{'_FillValue':np.float64(-9999.),
+        'units':'seconds since ' + TIME0.strftime('%Y-%m-%d %H:%M:%S'),
+        'long_name':'time'},
+        'data':(tavg - tavg.astype('datetime64[D]')) // np.timedelta64(1, 's')}
+
+    # Footprint variable
+    foot = np.tile(vpix['data'], nscn)[obuse]
+    keep['footprint'] = {'dims':(RECDIM,), 'dtype':vpix['dtype'],
+        'attrs':{'_FillValue':vpix['attrs'].get('_FillValue', None),
+        'units':vpix['attrs']['units'],
+        'long_name':vpix['attrs']['long_name'],
+        'comment':vpix['attrs']['comment']}, 'data':foot}
+
+    # Reshape and subset 1D variables
+    for vv in vnames1d:
+        var1 = orbit[vv]
+        var1rs = var1['data'].reshape(var1['data'].size,)
+        keep[vv] = dict(var1, dims=(RECDIM,), data=var1rs.data[obuse])
+
+    # Reshape and subset 2D variables
+    for vv in vnames2d:
+        var1 = orbit[vv]
+        var1rs = var1['data'].reshape(-1, var1['data'].shape[-1])
+        keep[vv] = dict(var1, dims=(RECDIM, var1['dims'][-1]),
+            data=var1rs[obuse,:])
+
+    # Average sounding locations in spherical coordinates to account for
+    # longitudinal periodicity (only for the soundings we keep)
+    latin = np.deg2rad(orbit['latitude']['data'].data.reshape(-1)[obuse])
+    lonin = np.deg2rad(orbit['longitude']['data'].data.reshape(-1)[obuse])
+
+    # Opposite cos/sin for lat than most formulas due to [-90,90] domain
+    xxavg = np.cos(lonin) * np.cos(latin)
+    yyavg = np.sin(lonin) * np.cos(latin)
+    zzavg =                 np.sin(latin)
+    rravg = np.sqrt(xxavg**2 + yyavg**2 + zzavg**2)
+
+    keep['latitude']['data']  = np.rad2deg(np.arcsin(zzavg/rravg))
+    keep['longitude']['data'] = np.rad2deg(np.arctan2(yyavg, xxavg))
+
+    # Someone always has to be special
+    # *** Always good to double check ***
+    if varlo == 'co' and ver[:2] == 'v1':
+        avgker = keep['column_averaging_kernel']
+        avgker['data'] = avgker['data']/1000.
+
+    # Sounding id from the date and footprint
+    duse = np.uint64(dvec)
+    fuse = np.uint64(foot.data)
+    keep['sounding_id'] = {'dims':(RECDIM,), 'dtype':np.dtype('uint64'),
+        'attrs':{'_FillValue':np.uint64(0), 'units':'HHMMSSFFFPPP',
+        'long_name':'S5P/TROPOMI sounding id',
+        'comment':('HH (hour), MM (minute), SS (second), ' +
+        'FFF (millisecond), PPP (ground pixel)')},
+        'data':(duse[:,3]*10**10 + duse[:,4]*10**8 +
+                duse[:,5]*10**6  + duse[:,6]*10**3 + fuse)}
+
+    return keep
+
+def _create_daily(fout):
+    '''Create a daily file with an unlimited sounding dimension'''
+    ncf = netCDF4.Dataset(fout, 'w')
+    ncf.history = 'Created on ' + datetime.now().isoformat()
+
+    # NB: Specifying fill_value causes xarray to muck up data type
+    ncf.createDimension(RECDIM, size=None)
+    snum = ncf.createVariable(RECDIM, 'int32', (RECDIM,), chunksizes=(NCHUNK,),
+        **ZARGS)
+    snum.units = '1'
+    snum.long_name = 'S5P/TROPOMI sounding number'
+
+    return ncf
+
+def _append(ncf, keep, sound0):
+    '''Append an orbit's soundings (keep) to a daily file starting at
+    sounding0, defining variables the first time they show up'''
+    nsound = keep['date']['data'].shape[0]
+    ncf.variables[RECDIM][sound0:sound0+nsound] = np.arange(sound0,
+        sound0 + nsound)
+
+    for vv, vin in keep.items():
+        if RECDIM not in vin['dims']:
+            if vv not in ncf.variables:
+                var = _define(ncf, vv, vin, **ZARGS)
+                var[:] = vin['data']
+            continue
+
+        if vv not in ncf.variables:
+            for dd, nn in zip(vin['dims'][1:], vin['data'].shape[1:]):
+                if dd not in ncf.dimensions: ncf.createDimension(dd, nn)
+            _define(ncf, vv, vin, vin['dims'],
+                chunksizes=(NCHUNK,) + vin['data'].shape[1:], **ZARGS)
+        ncf.variables[vv][sound0:sound0+nsound] = vin['data']
+
+    return sound0 + nsound
+
+def server(**xlargs):
+    '''Server the orbit files come from (see builder.schedule)'''
+    from xtralite.acquire import tropomi_download
+
+    return tropomi_download.download_url
 
 def setup(jdnow, **xlargs):
     from xtralite.acquire import default
@@ -62,6 +360,7 @@ def setup(jdnow, **xlargs):
     mod = modname
     xlargs['mod'] = mod
     xlargs['ftail'] = FTAIL
+    xlargs['granule'] = 'orbit'
 
     xlargs = default.setup(jdnow, **xlargs)
 
@@ -91,21 +390,13 @@ def setup(jdnow, **xlargs):
     return xlargs
 
 def acquire(jdnow, **xlargs):
-    # Check for NCO utilities
-    # (will be removed soon, some retrievals still use these)
-    try:
-        pout = Popen(['ncks', '--help'], stdout=PIPE)
-    except OSError:
-        sys.stderr.write('*** ERROR *** NCO executables not in $PATH\n\n')
-        sys.exit(2)
+    from xtralite.acquire import tropomi_download, tropomi_blend
 
     # Get retrieval arguments
     xlargs = setup(jdnow, **xlargs)
-    mod = xlargs['mod']
     var = xlargs['var']
     sat = xlargs['sat']
     ver = xlargs['ver']
-    wgargs = xlargs.get('wgargs', None)
 
     # Variables that everything has
     dnames    = ['layer']
@@ -124,12 +415,14 @@ def acquire(jdnow, **xlargs):
     CLMAX = 0.10			# Maximum value of cloud variable
     VCLOUD = 'cloud_fraction_crb'	# Cloud variable
     VCHECK = ''				# Variable whose mask we use
+    VBLEND = ''				# Blended variable to compute
 
     varlo = var.lower()
     if varlo == 'ch4':
         CLMAX = float('nan')
         VCLOUD = ''
         VCHECK = 'methane_mixing_ratio_bias_corrected'
+        VBLEND = 'methane_mixing_ratio_blended'
         dnames = dnames + ['level', 'corner']
         vnames1d = vnames1d + ['surface_albedo_SWIR',
             'surface_albedo_NIR',
@@ -191,8 +484,10 @@ def acquire(jdnow, **xlargs):
     yrnow = str(jdnow.year)
     dnow  = yrnow + str(jdnow.month).zfill(2) + str(jdnow.day).zfill(2)
 
+    # Temporary and orbit directories are per-day so days can be acquired
+    # in parallel without clobbering each other
     DLITE  = xlargs['daily']
-    DIRTMP = path.join(DLITE, 'tmp')
+    DIRTMP = path.join(DLITE, 'tmp', dnow)
     DORBIT = DLITE[:-6] + '_orbit'
     FHOUT  = xlargs['fhout']
 
@@ -230,7 +525,7 @@ def acquire(jdnow, **xlargs):
     fwild = '*_' + fmode + '_*_' + dnow + 'T*_*' + FTAIL
 
     # Download orbit files
-    DORNOW = path.join(DORBIT, 'Y'+yrnow)
+    DORNOW = path.join(DORBIT, 'Y'+yrnow, dnow)
     makedirs(DORNOW, exist_ok=True)
 #   for mm in range(-1,2):
 #       pout = call(WGETCMD + ' --load-cookies ~/.urs_cookies ' +
@@ -241,211 +536,67 @@ def acquire(jdnow, **xlargs):
 #           (jdnow + timedelta(mm)).strftime('%Y/%j') + '/' +
 #           ' -A "' + fwild + '" -P ' + path.join(DORBIT, 'Y'+yrnow),
 #           shell=True)
-    pout = call(['tropomi_download', varlo, jdnow.strftime('%Y-%m-%d'),
-        '--mode', fmode, '--ver', arver, '--output', DORNOW])
-    if varlo == 'ch4':
-        pout = call(['tropomi_blend', DORNOW,
-            files('xtralite.acquire').joinpath('tropomi_model.pkl.gz')])
+    # Called in-process so logins are reused from one day to the next.
+    # CDSE limits connections per user, so days acquired at once split
+    # them (see builder.SITES)
+    try:
+        nfail = tropomi_download.download(varlo, jdnow, mode=fmode,
+            ver=arver, dirout=DORNOW, jobs=xlargs.get('dljobs', None) or
+            tropomi_download.DEFJOBS)
+    except Exception as err:
+        sys.stderr.write(('*** WARNING *** Failed to download %s ' +
+            '(%s)\n\n') % (dnow, repr(err)))
+        nfail = None
+
+    # Leave incomplete days without a daily file, keeping the orbits (and
+    # partial downloads) we did get, so a rerun only gets what's missing
+    if nfail != 0:
+        sys.stderr.write(('*** WARNING *** Orbits missing for %s, not ' +
+            'making a daily file\n\n') % dnow)
+        return xlargs
 
     # Convert orbit files into daily lite files
     # ---
+    conf = {'dnames':dnames, 'vnames':vnames, 'vnames0d':vnames0d,
+        'vnames1d':vnames1d, 'vnames2d':vnames2d, 'LANDONLY':LANDONLY,
+        'QAMIN':QAMIN, 'CLMAX':CLMAX, 'VCLOUD':VCLOUD, 'VCHECK':VCHECK,
+        'VBLEND':VBLEND, 'varlo':varlo, 'ver':ver, 'fmodel':None}
+
+    # Blending is done as orbits are converted; the model is loaded here,
+    # once per process, so forked workers share it copy-on-write (other
+    # start methods load it once per worker in _init_worker)
+    initargs = (None,)
+    if 0 < len(VBLEND):
+        conf['fmodel'] = tropomi_blend.default_model()
+        tropomi_blend.load_model(conf['fmodel'])
+        initargs = (conf['fmodel'],)
+
+    # Orbits are independent, so convert them in parallel, splitting the
+    # processors between days being acquired at the same time
+    flist = sorted(glob(path.join(DORNOW, fwild)))
+    ftmp  = fout.replace(path.join(DLITE, 'Y'+yrnow), DIRTMP, 1)
+    makedirs(DIRTMP, exist_ok=True)
+
+    nproc = max(cpu_count() // max(xlargs.get('jobs',1) or 1, 1), 1)
+    nproc = max(min(nproc, len(flist)), 1)
+
+    # Stream orbits into the daily file in order as they finish, numbering
+    # soundings consecutively across the day; nothing is written for days
+    # without any soundings
+    ncf    = None
     sound0 = 0
-    flist  = glob(path.join(DORNOW, fwild))
-    for ff in sorted(flist):
-        # Create temporary filenames
-        fone = ('_one' + FTAIL).join(ff.rsplit(FTAIL,1))
-        ftwo = ('_two' + FTAIL).join(ff.rsplit(FTAIL,1))
-        fone = fone.replace(DORNOW, DIRTMP, 1)
-        ftwo = ftwo.replace(DORNOW, DIRTMP, 1)
-
-        makedirs(DIRTMP, exist_ok=True)
-
-        # Create temporary file with the variables we need (fone) and
-        # empty file with just the dimensions we need (ftwo)
-        pout = call(['ncks', '-O', '-3', '-G', ':', '-g', 'PRODUCT',
-            '-v', ','.join(vnames), ff, fone])
-        pout = call(['ncwa', '-O', '--no_cll_mth', '-a', 'time', fone, fone])
-        pout = call(['ncks', '-O', '-3', '-v', ','.join(dnames), fone, ftwo])
-        if len(vnames0d) > 0:
-            pout = call(['ncks', '-A', '-v', ','.join(vnames0d), fone, ftwo])
-
-        # Copy, reshape, and subset variables from fone to ftwo
-        ncf1 = netCDF4.Dataset(fone, 'r') 
-        ncf2 = netCDF4.Dataset(ftwo, 'a') 
-
-        # Only copy obs with valid data in correct day (obuse)
-        # About 2% of all soundings for CH4, almost everything for others
-        obchk = ncf1.variables[VCHECK]
-        time  = ncf1.variables['time']
-        delt  = ncf1.variables['delta_time']
-        vpix  = ncf1.variables['ground_pixel']
-        qa    = ncf1.variables['qa_value']
-        stype = ncf1.variables['surface_classification']
-
-        # Recall time dimension was deleted above
-        nscn = np.size(obchk, axis=0)
-        npix = np.size(obchk, axis=1)
-
-        if npix != vpix.size: raise
-
-        # Some annoying logic to deal with different delta_time dimensions
-        # HCHO and SO2 are unique with delta_time that has a ground_pixel
-        # dimension and missing time_utc values
-        dfix = delt[:].data[:,0] if (delt.shape == obchk.shape) else delt[:].data
-        tscn = np.array([TIME0 + timedelta(seconds=int(time[:].data[()])) +
-            timedelta(milliseconds=int(dd)) for dd in dfix])
-        tsnd = np.repeat(tscn, npix)
-        tuse = np.array([tt.date() == jdnow.date() for tt in tsnd])
-
-        # Decide who to keep
-        qause = ~np.less(qa, QAMIN)
-        obuse = np.logical_and(~obchk[:].mask, qause).reshape(obchk.size,)
-        obuse = np.logical_and(tuse, obuse)
-        mask  = (stype[:] % 2).reshape(obchk.size,)
-
-        if LANDONLY: obuse = np.logical_and(obuse, mask == 0)
-
-        # Add cloud flags
-        if 0 < len(VCLOUD):
-            cloud = ncf1.variables[VCLOUD]
-            cluse = np.less(cloud, CLMAX).reshape(obchk.size,)
-            obuse = np.logical_and(obuse, cluse)
-
-        # Create sounding dimension and variable
-        # NB: Specifying fill_value causes xarray to muck up data type
-        nsound = obuse[obuse].size
-
-#       sdim = ncf2.createDimension(RECDIM, size=None)
-        sdim = ncf2.createDimension(RECDIM, size=nsound)
-        snum = ncf2.createVariable(RECDIM, 'int32', (RECDIM,))
-        snum.units = '1'
-        snum.long_name = 'S5P/TROPOMI sounding number'
-        snum[:] = range(sound0, sound0 + nsound)
-        sound0  = sound0 + nsound
-
-        # Compute time for averaged sounding
-        tdel = np.array([dd.total_seconds()
-            for dd in (tsnd[obuse] - tsnd[0])])
-        tavg = np.array([tsnd[0] + timedelta(seconds=ss)
-            for ss in tdel])
-
-        # Create ndate dimension and date variable
-        tdim = ncf2.createDimension('ndate', size=7)
-        date = ncf2.createVariable('date', 'int16', (RECDIM,'ndate'),
-            fill_value=np.int16(-9999))
-        date.units = 'none'
-        date.long_name = 'Observation date and time matching sounding_id'
-        date.comment = ('Year, month (1-12), day (1-31), hour (0-23), ' +
-            'minute (0-59), second (0-59), millisecond (0-999). Note '  +
-            'this time is chosen to correspond exactly to the digits '  +
-            'in sounding_id')
-        date[:] = np.array([(tt.year, tt.month, tt.day, tt.hour, tt.minute,
-            tt.second, tt.microsecond//1000)
-            for tt in tavg])
-
-        # Create time variable
-        time = ncf2.createVariable('time', 'float64', (RECDIM,),
-            fill_value=np.float64(-9999.))
-        time.units = 'seconds since ' + TIME0.strftime('%Y-%m-%d %H:%M:%S')
-        time.long_name = 'time'
-        time[:] = np.array([(tt - TIME0).seconds for tt in tavg])
-
-        # Create footprint variable
-        foot = ncf2.createVariable('footprint', vpix.dtype, (RECDIM,),
-            fill_value=vpix._FillValue)
-        foot.units = vpix.units
-        foot.long_name = vpix.long_name
-        foot.comment = vpix.comment
-        foot[:] = np.tile(vpix, nscn)[obuse]
-
-        # Read, reshape, and write 1D variables
-        for vv in vnames1d:
-            var1 = ncf1.variables[vv]
-            var2 = ncf2.createVariable(vv, var1.dtype, (RECDIM,),
-                fill_value=var1._FillValue)
-            var2.setncatts(var1.__dict__)
-            var1rs  = var1[:].reshape(var1[:].size,)
-            var2[:] = var1rs[:].data[obuse]
-
-        # Read, reshape, and write 2D variables
-        for vv in vnames2d:
-            var1 = ncf1.variables[vv]
-            var2 = ncf2.createVariable(vv, var1.dtype, (RECDIM,var1.dimensions[-1]),
-                fill_value=var1._FillValue)
-            var2.setncatts(var1.__dict__)
-            var1rs  = var1[:].reshape(var1[:,:,0].size, var1[0,0,:].size)
-            for kk in range(np.size(var1rs,axis=1)):
-                var2[:,kk] = var1rs[obuse,kk]
-
-        # Average sounding locations in spherical coordinates to account for
-        # longitudinal periodicity
-        latin = ncf1.variables['latitude']
-        lonin = ncf1.variables['longitude']
-
-        # Opposite cos/sin for lat than most formulas due to [-90,90] domain
-        xx = np.cos(np.deg2rad(lonin[:].data)) * np.cos(np.deg2rad(latin[:].data))
-        yy = np.sin(np.deg2rad(lonin[:].data)) * np.cos(np.deg2rad(latin[:].data))
-        zz =                                     np.sin(np.deg2rad(latin[:].data))
-
-        xxavg = xx.reshape(xx.size,)[obuse]
-        yyavg = yy.reshape(yy.size,)[obuse]
-        zzavg = zz.reshape(zz.size,)[obuse]
-        rravg = np.sqrt(xxavg**2 + yyavg**2 + zzavg**2)
-
-        latout = ncf2.variables['latitude']
-        lonout = ncf2.variables['longitude']
-
-        latout[:] = np.rad2deg(np.arcsin(zzavg/rravg))
-        lonout[:] = np.rad2deg(np.arctan2(yyavg, xxavg))
-
-        # Someone always has to be special
-        # *** Always good to double check ***
-        if var.lower() == 'co' and ver[:2] == 'v1':
-            avgker = ncf2.variables['column_averaging_kernel']
-            avgker[:] = avgker[:]/1000.
-
-        ncf1.close()
-        ncf2.close()
-
-        # Hack so ncrcat doesn't choke on files with no data
-        if nsound == 0: pout = call(['rm', ftwo])
-
-    # Create lite file from orbit files
-    fcat = sorted(glob(path.join(DIRTMP, '*_'+dnow+'T*_*_two'+FTAIL)))
-    ftmp = fout.replace(path.join(DLITE, 'Y'+yrnow), DIRTMP, 1)
-    if len(fcat) > 0:
-        makedirs(path.join(DLITE, 'Y'+yrnow), exist_ok=True)
-
-        # Concatenate, then convert back to netCDF4, two ways:
-        dtmp = xr.open_mfdataset(fcat, mask_and_scale=False)
-        dtmp.to_netcdf(ftmp, encoding={RECDIM:{'dtype':'int32'}})
-        dtmp.close()
-
-        # Create sounding_id variable once back in netCDF4
-        ncf  = netCDF4.Dataset(ftmp, 'a')
-        date = ncf.variables['date']
-        foot = ncf.variables['footprint']
-
-        sids = ncf.createVariable('sounding_id', 'uint64', (RECDIM,),
-            fill_value=np.uint64(0))
-        sids.units = 'HHMMSSFFFPPP'
-        sids.long_name = 'S5P/TROPOMI sounding id'
-        sids.comment = ('HH (hour), MM (minute), SS (second), FFF (millisecond), ' +
-            'PPP (ground pixel)')
-        duse = np.uint64(date[:].data)
-        fuse = np.uint64(foot[:].data)
-        sids[:] = (duse[:,3]*10**10 + duse[:,4]*10**8 +
-                   duse[:,5]*10**6  + duse[:,6]*10**3 + fuse)
-
-        if hasattr(ncf, 'history_of_appended_files'):
-            delattr(ncf, 'history_of_appended_files')
-
+    with ProcessPoolExecutor(max_workers=nproc,
+        initializer=tropomi_blend._init_worker, initargs=initargs) as pool:
+        for keep in pool.map(_convert_orbit, flist, [jdnow]*len(flist),
+            [conf]*len(flist)):
+            if len(keep) == 0: continue
+            if ncf is None: ncf = _create_daily(ftmp)
+            sound0 = _append(ncf, keep, sound0)
+
+    if ncf is not None:
         ncf.close()
-
-        # Compress and overwrite history
-        pout = call(['ncks', '-O', '-L', '9', ftmp, fout])
-        pout = call(['ncatted', '-h', '-O', '-a', 'history,global,o,c,' +
-            'Created on ' + datetime.now().isoformat(), fout])
+        makedirs(path.join(DLITE, 'Y'+yrnow), exist_ok=True)
+        replace(ftmp, fout)
 
     # Slightly terrifying
     if RMTMPS:
@@ -456,7 +607,7 @@ def acquire(jdnow, **xlargs):
             pass
     if RMORBS:
         try:
-            rmtree(DORBIT)
+            rmtree(DORNOW)
         except Exception as e:
             print(e)
             pass
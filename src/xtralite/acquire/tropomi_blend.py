@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import os
 from os import path
 from glob import glob
 from netCDF4 import Dataset
@@ -18,52 +19,205 @@ sys.dont_write_bytecode = True
 aa = 1.18
 bb = -0.40
 
+# Comment on blended variables
+COMMENT = 'produced as described in Balasus et al. (2023)'
 
-def predict_delta(file, model):
-    # Transform TROPOMI netCDF file into pandas dataframe
-    with Dataset(file) as ds:
-        mask = ds['PRODUCT/qa_value'][:] == 1.0
-        # Predictor variables (need to maintain compat w/ training)
-        df = pd.DataFrame({
-            "solar_zenith_angle": ds["PRODUCT/SUPPORT_DATA/GEOLOCATIONS/solar_zenith_angle"][:][mask],
-            "relative_azimuth_angle": np.abs(180 - np.abs(ds["PRODUCT/SUPPORT_DATA/GEOLOCATIONS/solar_azimuth_angle"][:][mask] -
-                ds["PRODUCT/SUPPORT_DATA/GEOLOCATIONS/viewing_azimuth_angle"][:][mask])),
-            "across_track_pixel_index": np.expand_dims(np.tile(ds["PRODUCT/ground_pixel"][:], (mask.shape[1],1)), axis=0)[mask],
-            "surface_classification": (ds["PRODUCT/SUPPORT_DATA/INPUT_DATA/surface_classification"][:][mask] & 0x03).astype(int),
-            "surface_altitude": ds["PRODUCT/SUPPORT_DATA/INPUT_DATA/surface_altitude"][:][mask],
-            "surface_altitude_precision": ds["PRODUCT/SUPPORT_DATA/INPUT_DATA/surface_altitude_precision"][:][mask],
-            "eastward_wind": ds["PRODUCT/SUPPORT_DATA/INPUT_DATA/eastward_wind"][:][mask],
-            "northward_wind": ds["PRODUCT/SUPPORT_DATA/INPUT_DATA/northward_wind"][:][mask],
-            "xch4_apriori": np.sum(ds["PRODUCT/SUPPORT_DATA/INPUT_DATA/methane_profile_apriori"][:][mask]/
-                np.expand_dims(np.sum(ds["PRODUCT/SUPPORT_DATA/INPUT_DATA/dry_air_subcolumns"][:][mask], axis=1),axis=1), axis=1)*1e9,
-            "reflectance_cirrus_VIIRS_SWIR": ds["PRODUCT/SUPPORT_DATA/INPUT_DATA/reflectance_cirrus_VIIRS_SWIR"][:][mask],
-            "xch4_precision": ds["PRODUCT/methane_mixing_ratio_precision"][:][mask],
-            "fluorescence": ds["PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/fluorescence"][:][mask],
-            "co_column": ds["PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/carbonmonoxide_total_column"][:][mask],
-            "co_column_precision": ds["PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/carbonmonoxide_total_column_precision"][:][mask],
-            "h2o_column": ds["PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/water_total_column"][:][mask],
-            "h2o_column_precision": ds["PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/water_total_column_precision"][:][mask],
-            "aerosol_size": ds["PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/aerosol_size"][:][mask],
-            "aerosol_size_precision": ds["PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/aerosol_size_precision"][:][mask],
-            "aerosol_height": ds["PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/aerosol_mid_altitude"][:][mask],
-            "aerosol_height_precision": ds["PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/aerosol_mid_altitude_precision"][:][mask],
-            "aerosol_column": ds["PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/aerosol_number_column"][:][mask],
-            "aerosol_column_precision": ds["PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/aerosol_number_column_precision"][:][mask],
-            "surface_albedo_SWIR": ds["PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/surface_albedo_SWIR"][:][mask],
-            "surface_albedo_SWIR_precision": ds["PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/surface_albedo_SWIR_precision"][:][mask],
-            "surface_albedo_NIR": ds["PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/surface_albedo_NIR"][:][mask],
-            "surface_albedo_NIR_precision": ds["PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/surface_albedo_NIR_precision"][:][mask],
-            "aerosol_optical_thickness_SWIR": ds["PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/aerosol_optical_thickness_SWIR"][:][mask],
-            "aerosol_optical_thickness_NIR": ds["PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/aerosol_optical_thickness_NIR"][:][mask],
-            "chi_square_SWIR": ds["PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/chi_square_SWIR"][:][mask],
-            "chi_square_NIR": ds["PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/chi_square_NIR"][:][mask]
-        })
-
-    df = df.add_prefix('tropomi_')
+# Predictor variables (need to maintain compat w/ training)
+GEO = 'PRODUCT/SUPPORT_DATA/GEOLOCATIONS/'
+INP = 'PRODUCT/SUPPORT_DATA/INPUT_DATA/'
+DET = 'PRODUCT/SUPPORT_DATA/DETAILED_RESULTS/'
+FEATURES = ['solar_zenith_angle', 'relative_azimuth_angle',
+    'across_track_pixel_index', 'surface_classification', 'surface_altitude',
+    'surface_altitude_precision', 'eastward_wind', 'northward_wind',
+    'xch4_apriori', 'reflectance_cirrus_VIIRS_SWIR', 'xch4_precision',
+    'fluorescence', 'co_column', 'co_column_precision', 'h2o_column',
+    'h2o_column_precision', 'aerosol_size', 'aerosol_size_precision',
+    'aerosol_height', 'aerosol_height_precision', 'aerosol_column',
+    'aerosol_column_precision', 'surface_albedo_SWIR',
+    'surface_albedo_SWIR_precision', 'surface_albedo_NIR',
+    'surface_albedo_NIR_precision', 'aerosol_optical_thickness_SWIR',
+    'aerosol_optical_thickness_NIR', 'chi_square_SWIR', 'chi_square_NIR']
+
+# Predictors read straight from the file (the rest are derived)
+FVARS = {
+    'solar_zenith_angle': GEO + 'solar_zenith_angle',
+    'surface_altitude': INP + 'surface_altitude',
+    'surface_altitude_precision': INP + 'surface_altitude_precision',
+    'eastward_wind': INP + 'eastward_wind',
+    'northward_wind': INP + 'northward_wind',
+    'reflectance_cirrus_VIIRS_SWIR': INP + 'reflectance_cirrus_VIIRS_SWIR',
+    'xch4_precision': 'PRODUCT/methane_mixing_ratio_precision',
+    'fluorescence': DET + 'fluorescence',
+    'co_column': DET + 'carbonmonoxide_total_column',
+    'co_column_precision': DET + 'carbonmonoxide_total_column_precision',
+    'h2o_column': DET + 'water_total_column',
+    'h2o_column_precision': DET + 'water_total_column_precision',
+    'aerosol_size': DET + 'aerosol_size',
+    'aerosol_size_precision': DET + 'aerosol_size_precision',
+    'aerosol_height': DET + 'aerosol_mid_altitude',
+    'aerosol_height_precision': DET + 'aerosol_mid_altitude_precision',
+    'aerosol_column': DET + 'aerosol_number_column',
+    'aerosol_column_precision': DET + 'aerosol_number_column_precision',
+    'surface_albedo_SWIR': DET + 'surface_albedo_SWIR',
+    'surface_albedo_SWIR_precision': DET + 'surface_albedo_SWIR_precision',
+    'surface_albedo_NIR': DET + 'surface_albedo_NIR',
+    'surface_albedo_NIR_precision': DET + 'surface_albedo_NIR_precision',
+    'aerosol_optical_thickness_SWIR': DET + 'aerosol_optical_thickness_SWIR',
+    'aerosol_optical_thickness_NIR': DET + 'aerosol_optical_thickness_NIR',
+    'chi_square_SWIR': DET + 'chi_square_SWIR',
+    'chi_square_NIR': DET + 'chi_square_NIR',
+}
+
+# Models already loaded in this process, by filename
+MODELS = {}
+
+# Memory needed per worker (GB)
+DEFMEM = 2.
+
+# Exported models are tree ensembles stored as flat arrays: each tree starts
+# at a root node, split nodes send x <= threshold left (missing values go
+# the way nanleft says), and leaves (left == -1) hold values scaled so the
+# prediction is base plus the sum of one leaf per tree
+TREEKEYS = ['roots', 'left', 'right', 'feature', 'threshold', 'nanleft',
+    'zeromiss', 'value', 'base', 'features']
+
+# Rows sent down the trees at once by the evaluator
+NBATCH = 1024
+
+# LightGBM treats anything this small as zero
+KZERO = 1e-35
+
+# LightGBM objectives with no output transform
+LGBLINEAR = ['regression', 'regression_l1', 'huber', 'fair', 'quantile',
+    'mape']
+
+
+def feature_matrix(ds, mask, scans=slice(None)):
+    # Build predictors for the soundings in mask in one float32 array,
+    # reading each variable once over just the scanlines in scans (columns
+    # in FEATURES order; mask is scanline by ground_pixel)
+    col = {name:kk for kk, name in enumerate(FEATURES)}
+    X = np.empty((int(np.sum(mask)), len(FEATURES)), dtype='float32')
+
+    # Time dimension has length 1
+    def _read(vname):
+        return np.ma.filled(ds[vname][0,scans][mask].astype('float32'),
+            np.nan)
+
+    for name, vname in FVARS.items():
+        X[:,col[name]] = _read(vname)
+
+    # Derived predictors
+    saa = _read(GEO + 'solar_azimuth_angle')
+    vaa = _read(GEO + 'viewing_azimuth_angle')
+    X[:,col['relative_azimuth_angle']] = np.abs(180 - np.abs(saa - vaa))
+
+    pixel = ds['PRODUCT/ground_pixel'][:]
+    X[:,col['across_track_pixel_index']] = np.broadcast_to(pixel,
+        mask.shape)[mask]
+
+    stype = ds[INP + 'surface_classification'][0,scans][mask]
+    X[:,col['surface_classification']] = np.ma.filled(
+        (stype & 0x03).astype('float32'), np.nan)
+
+    apri = _read(INP + 'methane_profile_apriori')
+    dry  = _read(INP + 'dry_air_subcolumns')
+    X[:,col['xch4_apriori']] = np.sum(apri/np.sum(dry, axis=1,
+        keepdims=True), axis=1)*1e9
+
+    return X
+
+
+def _walk(trees):
+    # Leaves point back at themselves so every row can take the same number
+    # of steps (the depth of the deepest tree); children are interleaved so
+    # the next node is child[2*node + goright]
+    if 'child' in trees: return trees
+
+    left = trees['left']
+    leaf = left < 0
+    idx = np.arange(left.size)
+    child = np.stack((np.where(leaf, idx, left),
+        np.where(leaf, idx, trees['right'])), axis=1).ravel()
+
+    depth = 0
+    nodes = trees['roots']
+    while True:
+        nodes = nodes[~leaf[nodes]]
+        if nodes.size == 0: break
+        nodes = np.concatenate((left[nodes], trees['right'][nodes]))
+        depth = depth + 1
+
+    trees['child'] = child
+    trees['depth'] = depth
+
+    return trees
+
+
+def predict_trees(trees, X):
+    # Send each batch of rows down all the trees at once, a level at a time
+    trees = _walk(trees)
+    child = trees['child']
+    feature = trees['feature']
+    threshold = trees['threshold']
+    nanleft = trees['nanleft']
+    zeromiss = trees['zeromiss']
+    anyzero = bool(np.any(zeromiss))
+
+    nfeat = X.shape[1]
+    yy = np.full(X.shape[0], float(trees['base']))
+    for i0 in range(0, X.shape[0], NBATCH):
+        xx = np.ascontiguousarray(X[i0:i0+NBATCH])
+        xflat = xx.ravel()
+        offset = (np.arange(xx.shape[0]) * nfeat)[:,None]
+        node = np.tile(trees['roots'], (xx.shape[0], 1))
+
+        # Missing values are rare, so only look for them when there are some
+        check = anyzero or bool(np.any(np.isnan(xx)))
+        for nd in range(trees['depth']):
+            xv = xflat[offset + feature[node]]
+            if check:
+                miss = np.isnan(xv)
+                if anyzero:
+                    miss = miss | (zeromiss[node] & (np.abs(xv) <= KZERO))
+                goright = ~np.where(miss, nanleft[node],
+                    xv <= threshold[node])
+            else:
+                goright = threshold[node] < xv
+            node = child[2*node + goright]
+
+        yy[i0:i0+xx.shape[0]] += np.sum(trees['value'][node], axis=1)
+
+    return yy
+
+
+def predict_delta(ds, mask, model, scans=slice(None)):
+    X = feature_matrix(ds, mask, scans)
+
+    # Exported models take the array as is
+    if isinstance(model, dict):
+        return aa * predict_trees(model, X) + bb
+
+    # Wrap the array so the model sees the names it was trained with
+    # (no copy since it's all one dtype)
+    df = pd.DataFrame(X, columns=['tropomi_' + ff for ff in FEATURES],
+        copy=False)
 
     return aa * model.predict(df) + bb
 
 
+def blended(ds, xch4, mask, model, scans=slice(None)):
+    # Blended XCH4 is the bias-corrected XCH4 (xch4, over the scanlines in
+    # scans) less the predicted delta where mask is set (qa_value == 1)
+    xx = np.ma.array(xch4, copy=True)
+
+    # model.predict fails with an empty dataframe
+    if np.sum(mask) != 0:
+        xx[mask] = xx[mask] - predict_delta(ds, mask, model, scans)
+
+    return xx
+
+
 # Function to write a BLND file given a RPRO or OFFL file
 def write_blended_files(file, model):
     print(f'Writing {file}', flush=True)
@@ -71,7 +225,7 @@ def write_blended_files(file, model):
     with Dataset(file, 'a') as ds:
         product = ds.groups['PRODUCT']
         xch4a = product['methane_mixing_ratio_bias_corrected']
-        mask = product['qa_value'][:] == 1.0
+        mask = product['qa_value'][0] == 1.0
 
         # Add blended xch4
         vname = 'methane_mixing_ratio_blended'
@@ -80,19 +234,291 @@ def write_blended_files(file, model):
                 vname, xch4a.datatype, xch4a.dimensions
             )
             xch4b.setncatts(xch4a.__dict__)
-            xch4b.setncattr(
-                'comment', 'produced as described in Balasus et al. (2023)'
-            )
+            xch4b.setncattr('comment', COMMENT)
         else:
             xch4b = product[vname]
 
-        # model.predict fails with an empty dataframe
+        # Careful: netCDF4 doesn't like 2d masks and other ways to do this
+        # produce garbage with no error messages
         if np.sum(mask) != 0:
-            # Careful: netCDF4 doesn't like 2d masks and other ways to do this
-            # produce garbage with no error messages
-            xx = np.array(xch4a[:])
-            xx[mask] = xx[mask] - predict_delta(file, model)
-            xch4b[:] = xx
+            xch4b[0] = blended(ds, xch4a[0], mask, model)
+
+    return
+
+
+def _columns(names, nfeat):
+    # Map model feature numbers to columns of the feature matrix, assuming
+    # FEATURES order if the model doesn't know its feature names
+    if names is None:
+        if nfeat != len(FEATURES):
+            raise ValueError('Model has %d features, expected %d' %
+                (nfeat, len(FEATURES)))
+        return np.arange(len(FEATURES))
+
+    col = {'tropomi_' + name:kk for kk, name in enumerate(FEATURES)}
+    col.update({name:kk for kk, name in enumerate(FEATURES)})
+    unknown = [str(name) for name in names if str(name) not in col]
+    if len(unknown) != 0:
+        raise ValueError('Unknown model features: ' + ', '.join(unknown))
+
+    return np.array([col[str(name)] for name in names])
+
+
+def _join_trees(trees, base):
+    # Concatenate per-tree node arrays, offsetting child indices
+    out = {kk:[] for kk in TREEKEYS if kk not in ['base', 'features']}
+    nnode = 0
+    for tree in trees:
+        out['roots'].append(nnode)
+        for kk in ['left', 'right']:
+            cc = np.asarray(tree[kk])
+            out[kk].append(np.where(cc < 0, -1, cc + nnode))
+        for kk in ['feature', 'threshold', 'nanleft', 'zeromiss', 'value']:
+            out[kk].append(np.asarray(tree[kk]))
+        nnode = nnode + len(tree['left'])
+
+    dtypes = {'roots':'int32', 'left':'int32', 'right':'int32',
+        'feature':'int32', 'threshold':'float64', 'nanleft':'bool',
+        'zeromiss':'bool', 'value':'float64'}
+    out = {kk:np.concatenate([np.ravel(vv) for vv in out[kk]])
+        .astype(dtypes[kk]) for kk in out}
+    out['base'] = np.float64(base)
+    out['features'] = np.array(FEATURES)
+
+    return out
+
+
+def _sklearn_tree(est, cols, scale):
+    # One fitted sklearn tree (tree_ arrays); leaves have children == -1
+    tt = est.tree_
+    leaf = tt.children_left < 0
+    # Before sklearn 1.3 NaNs weren't allowed, and they'd go right
+    nanleft = getattr(tt, 'missing_go_to_left', np.zeros(tt.node_count))
+
+    return {'left': tt.children_left, 'right': tt.children_right,
+        'feature': np.where(leaf, 0, cols[np.maximum(tt.feature, 0)]),
+        'threshold': np.where(leaf, 0., tt.threshold),
+        'nanleft': np.asarray(nanleft, dtype=bool) & ~leaf,
+        'zeromiss': np.zeros(tt.node_count, dtype=bool),
+        'value': np.where(leaf, scale * tt.value[:,0,0], 0.)}
+
+
+def _sklearn_hist(nodes, cols):
+    # One HistGradientBoosting predictor (structured node array)
+    if np.any(nodes['is_categorical']):
+        raise ValueError('Categorical splits are not supported')
+    leaf = nodes['is_leaf'].astype(bool)
+
+    return {'left': np.where(leaf, -1, nodes['left'].astype('int64')),
+        'right': np.where(leaf, -1, nodes['right'].astype('int64')),
+        'feature': np.where(leaf, 0, cols[nodes['feature_idx']]),
+        'threshold': np.where(leaf, 0., nodes['num_threshold']),
+        'nanleft': nodes['missing_go_to_left'].astype(bool) & ~leaf,
+        'zeromiss': np.zeros(leaf.size, dtype=bool),
+        'value': np.where(leaf, nodes['value'], 0.)}
+
+
+def _lightgbm_tree(root, cols, scale):
+    # Flatten one LightGBM tree (nested dicts from dump_model) depth first
+    tree = {kk:[] for kk in ['left', 'right', 'feature', 'threshold',
+        'nanleft', 'zeromiss', 'value']}
+    stack = [(root, None, None)]
+    while len(stack) != 0:
+        node, parent, side = stack.pop()
+        nn = len(tree['left'])
+        if parent is not None: tree[side][parent] = nn
+
+        if 'leaf_value' in node:
+            tree['left'].append(-1)
+            tree['right'].append(-1)
+            tree['feature'].append(0)
+            tree['threshold'].append(0.)
+            tree['nanleft'].append(False)
+            tree['zeromiss'].append(False)
+            tree['value'].append(scale * node['leaf_value'])
+            continue
+
+        if node['decision_type'] != '<=':
+            raise ValueError('Categorical splits are not supported')
+
+        # NaNs are zeros unless they're their own missing type
+        missing = node.get('missing_type', 'None')
+        thresh = float(node['threshold'])
+        nanleft = bool(node['default_left'])
+        if missing == 'None': nanleft = 0. <= thresh
+
+        tree['left'].append(-1)
+        tree['right'].append(-1)
+        tree['feature'].append(cols[node['split_feature']])
+        tree['threshold'].append(thresh)
+        tree['nanleft'].append(nanleft)
+        tree['zeromiss'].append(missing == 'Zero')
+        tree['value'].append(0.)
+
+        stack.append((node['right_child'], nn, 'right'))
+        stack.append((node['left_child'], nn, 'left'))
+
+    return tree
+
+
+def tree_arrays(model):
+    # Convert a fitted regressor into flat tree arrays (see TREEKEYS);
+    # supports LightGBM and sklearn's tree, forest, and boosting models
+    booster = getattr(model, 'booster_', model)
+    if hasattr(booster, 'dump_model'):
+        dump = booster.dump_model()
+        objective = dump.get('objective', 'regression').split()[0]
+        if objective not in LGBLINEAR:
+            raise ValueError('Unsupported objective (%s)' % objective)
+        cols = _columns(dump.get('feature_names'),
+            dump['max_feature_idx'] + 1)
+        scale = 1.
+        if dump.get('average_output', False):
+            scale = 1. / len(dump['tree_info'])
+        trees = [_lightgbm_tree(tt['tree_structure'], cols, scale)
+            for tt in dump['tree_info']]
+        return _join_trees(trees, 0.)
+
+    cols = _columns(getattr(model, 'feature_names_in_', None),
+        model.n_features_in_)
+
+    if hasattr(model, '_predictors'):
+        trees = [_sklearn_hist(pp[0].nodes, cols) for pp in model._predictors]
+        return _join_trees(trees, np.ravel(model._baseline_prediction)[0])
+
+    if hasattr(model, 'tree_'):
+        return _join_trees([_sklearn_tree(model, cols, 1.)], 0.)
+
+    if hasattr(model, 'learning_rate'):
+        # Gradient boosting: initial estimate plus shrunken trees
+        base = 0.
+        if model.init_ != 'zero':
+            base = model.init_.predict(np.zeros((1, model.n_features_in_)))
+            base = np.ravel(base)[0]
+        trees = [_sklearn_tree(est, cols, model.learning_rate)
+            for est in np.ravel(model.estimators_)]
+        return _join_trees(trees, base)
+
+    if hasattr(model, 'estimators_'):
+        # Forests average their trees
+        scale = 1. / len(model.estimators_)
+        trees = [_sklearn_tree(est, cols, scale) for est in model.estimators_]
+        return _join_trees(trees, 0.)
+
+    raise ValueError('Unsupported model (%s)' % type(model).__name__)
+
+
+def _check_export(model, trees, nsamp=10000, rtol=1e-6):
+    # Compare exported predictions with the model's own on random inputs
+    # spanning the split thresholds
+    rng = np.random.default_rng(0)
+    X = np.zeros((nsamp, len(FEATURES)), dtype='float32')
+    split = trees['left'] >= 0
+    for kk in range(len(FEATURES)):
+        thresh = trees['threshold'][split & (trees['feature'] == kk)]
+        # Splits on missing values alone have huge thresholds
+        thresh = thresh[np.abs(thresh) < 1e30]
+        if thresh.size == 0: continue
+        X[:,kk] = rng.choice(thresh, nsamp) + rng.normal(0.,
+            np.std(thresh) + 1e-3, nsamp)
+
+    df = pd.DataFrame(X, columns=['tropomi_' + ff for ff in FEATURES],
+        copy=False)
+    if hasattr(model, 'feature_names_in_'):
+        df = df[list(model.feature_names_in_)]
+    elif hasattr(getattr(model, 'booster_', model), 'dump_model'):
+        names = getattr(model, 'booster_', model).feature_name()
+        if all(nn in df.columns for nn in names): df = df[names]
+    yref = np.asarray(model.predict(df))
+    yarr = predict_trees(trees, X)
+
+    err = np.max(np.abs(yarr - yref) / np.maximum(np.abs(yref), 1.))
+    if rtol < err:
+        raise ValueError('Exported model differs from original (%g)' % err)
+
+    return err
+
+
+def export_model(fmodel, fout):
+    # Save a pickled model as flat tree arrays that load quickly and need
+    # nothing but numpy to evaluate
+    model = load_model(fmodel)
+    trees = tree_arrays(model)
+    err = _check_export(model, trees)
+    np.savez_compressed(fout, **{kk:trees[kk] for kk in TREEKEYS})
+    print(f'Wrote {fout} ({trees["roots"].size} trees, '
+        f'{trees["left"].size} nodes, max rel. diff {err:g})', flush=True)
+
+
+def default_model():
+    # Packaged model, preferring the exported version if there is one
+    here = path.dirname(path.abspath(__file__))
+    fmodel = path.join(here, 'tropomi_model.npz')
+    if not path.isfile(fmodel):
+        fmodel = path.join(here, 'tropomi_model.pkl.gz')
+
+    return fmodel
+
+
+def load_model(fmodel):
+    # Unpickling the model takes a while, so only do it once per process
+    # (exported models are just arrays)
+    fmodel = str(fmodel)
+    if fmodel not in MODELS:
+        if fmodel.endswith('.npz'):
+            with np.load(fmodel) as fid:
+                MODELS[fmodel] = {kk:fid[kk] for kk in fid.files}
+        elif fmodel.endswith('.gz'):
+            with gzip.open(fmodel, 'rb') as fid:
+                MODELS[fmodel] = pickle.load(fid)
+        else:
+            with open(fmodel, 'rb') as fid:
+                MODELS[fmodel] = pickle.load(fid)
+
+    return MODELS[fmodel]
+
+
+def _init_worker(fmodel):
+    # Each worker gets its own copy of the model once, instead of with
+    # every task (with fork, it's already here and shared copy-on-write)
+    if fmodel is not None: load_model(fmodel)
+
+
+def _blend_file(file, fmodel):
+    write_blended_files(file, load_model(fmodel))
+
+
+def _num_workers(nfiles, jobs=None, memper=DEFMEM):
+    # As many cores as you have, but no more than fit in available memory
+    # (memper is GB per worker)
+    nproc = min(jobs or multiprocessing.cpu_count(), nfiles)
+    try:
+        avail = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        avail = None
+    if avail is not None and memper is not None and 0 < memper:
+        nproc = min(nproc, int(avail / (memper * 2**30)))
+
+    return max(nproc, 1)
+
+
+def blend(dirin, fmodel, jobs=None, memper=DEFMEM):
+    fmodel = str(fmodel)
+    model = load_model(fmodel)
+
+    # Write BLND files using as many workers as we can
+    files = sorted(glob(path.join(dirin, '*.nc')))
+    if len(files) == 0: return
+
+    num_processes = _num_workers(len(files), jobs, memper)
+    if num_processes == 1:
+        for ff in files:
+            write_blended_files(ff, model)
+        return
+
+    with multiprocessing.Pool(processes=num_processes,
+        initializer=_init_worker, initargs=(fmodel,)) as pool:
+        pool.starmap(_blend_file, [(ff, fmodel) for ff in files])
 
     return
 
@@ -103,27 +529,33 @@ def main():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
     parser.add_argument(
-        'dirin', metavar='dir', type=str, help='input directory'
+        'dirin', metavar='dir', type=str, nargs='?', help='input directory'
+    )
+    parser.add_argument(
+        'model', metavar='model', type=str,
+        help='model pickle (or exported .npz) file'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        help='maximum number of workers (default: number of cores)'
     )
     parser.add_argument(
-        'model', metavar='model', type=str, help='model pickle file'
+        '-m', '--memory', type=float, default=DEFMEM,
+        help='memory needed per worker in GB, 0 for no limit'
+    )
+    parser.add_argument(
+        '-e', '--export', metavar='npz', type=str, default=None,
+        help='export model to arrays in this file instead of blending'
     )
     args = parser.parse_args()
 
-    if args.model.endswith('.gz'):
-        with gzip.open(args.model, 'rb') as fid:
-            model = pickle.load(fid)
-    else:
-        with open(args.model, 'rb') as fid:
-            model = pickle.load(fid)
-
-    # Write BLND files using as many cores as you have
-    files = sorted(glob(path.join(args.dirin, '*.nc')))
-    num_processes = min(multiprocessing.cpu_count(), len(files))
-    with multiprocessing.Pool(processes=num_processes) as pool:
-        pool.starmap(write_blended_files, [(ff, model) for ff in files])
-        pool.close()
-        pool.join()
+    if args.export is not None:
+        export_model(args.model, args.export)
+        return
+    if args.dirin is None:
+        parser.error('the following arguments are required: dir')
+
+    blend(args.dirin, args.model, jobs=args.jobs, memper=args.memory)
 
 
 if __name__ == '__main__':
@@ -7,21 +7,41 @@ import requests
 import pandas as pd
 import xarray as xr
 import sys
-from os import path, makedirs
+import threading
+import hashlib
+import sqlite3
+from os import path, makedirs, remove, getenv
 import argparse
 import re
 from datetime import datetime, timedelta
 from netrc import netrc
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+
+from xtralite.acquire import fetch
 
 VARLIST = ['ch4', 'co', 'hcho', 'so2', 'no2', 'o3']
 MODELIST = ['RPRO', 'OFFL', 'NRTI']
 DEFVER = None
 DEFOUT = '.'
-MAXTRIES = 10
+DEFJOBS = 4
+BLOCKSIZE = 1024*1024
+TIMEOUT = 60
+
+# Catalogue cache; reprocessed (RPRO) entries don't change, so they're kept
+# forever, but others are refetched after a while (in seconds).  Windows
+# ending within the product latency (in days) may still be missing granules,
+# so they're refetched as often as near real-time ones
+CACHEDIR = path.join(getenv('XDG_CACHE_HOME',
+    path.join(path.expanduser('~'), '.cache')), 'xtralite')
+CACHETTL = {'RPRO':None, 'OFFL':86400, 'NRTI':3600}
+LATENCY = {'RPRO':5, 'OFFL':5, 'NRTI':1}
+
+# Tokens shared by all downloads in this process (see get_token_manager)
+TOKENS = {'lock':threading.Lock()}
 
 token_url = 'https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token'
 search_url = 'https://catalogue.dataspace.copernicus.eu/odata/v1/Products'
+download_url = 'https://download.dataspace.copernicus.eu/odata/v1/Products'
 
 def get_date(ss) -> datetime:
     try:
@@ -34,7 +54,7 @@ def get_tokens(username: str, password: str) -> tuple[str, str]:
         'password':password, 'grant_type':'password'}
 
     try:
-        response = requests.post(token_url, data=auth_data)
+        response = requests.post(token_url, data=auth_data, timeout=TIMEOUT)
         response.raise_for_status()
     except Exception as e:
         raise Exception(f'Keycloak token creation failed. ' +
@@ -48,7 +68,7 @@ def refresh_access_token(refresh_token: str) -> str:
         'grant_type': 'refresh_token'}
 
     try:
-        response = requests.post(token_url, data=auth_data)
+        response = requests.post(token_url, data=auth_data, timeout=TIMEOUT)
         response.raise_for_status()
     except Exception as e:
         raise Exception(f'Access token refresh failed. ' +
@@ -57,10 +77,23 @@ def refresh_access_token(refresh_token: str) -> str:
 
     return response.json()['access_token']
 
-def get_orbits(var: str, today: datetime, mode=None, ver=DEFVER):
-    product = 'L2__' + var.upper() + '_'*(6 - len(var))
-    tomrw = today + timedelta(days=1)
-
+def _md5(checksums) -> str:
+    # Catalogue entries list checksums for several algorithms
+    if not isinstance(checksums, list): return None
+    for cc in checksums:
+        if cc.get('Algorithm', '').upper() == 'MD5' and cc.get('Value'):
+            return cc['Value'].lower()
+    return None
+
+def _md5sum(ff: str, md5=None):
+    # Hash a file in blocks, optionally continuing an existing hash
+    if md5 is None: md5 = hashlib.md5()
+    with open(ff, 'rb') as fid:
+        for block in iter(lambda: fid.read(BLOCKSIZE), b''):
+            md5.update(block)
+    return md5
+
+def _query(product: str, beg: datetime, end: datetime) -> list:
     # Define querying variables
     # A full list of options is available at
     # https://catalogue.dataspace.copernicus.eu/odata/v1/Attributes(SENTINEL-5P)
@@ -68,27 +101,110 @@ def get_orbits(var: str, today: datetime, mode=None, ver=DEFVER):
     f1 = "Collection/Name eq 'SENTINEL-5P'"
     f2 = ("Attributes/OData.CSC.StringAttribute/any(att:att/Name" +
         f" eq 'productType' and att/OData.CSC.StringAttribute/Value eq '{product}')")
-    f3 = f"ContentDate/End gt {today.isoformat(timespec='milliseconds')}Z"
-    f4 = f"ContentDate/Start lt {tomrw.isoformat(timespec='milliseconds')}Z"
+    f3 = f"ContentDate/End gt {beg.isoformat(timespec='milliseconds')}Z"
+    f4 = f"ContentDate/Start lt {end.isoformat(timespec='milliseconds')}Z"
     params = {
         '$filter':f"{f1} and {f2} and {f3} and {f4}",
         '$top':1000,
         '$orderby':'ContentDate/Start asc',
     }
 
-    response = requests.get(search_url, params=params)
-    if response.status_code != 200:
-        if response.json().get('detail') is not None:
-            print(response.json().get('detail').get('message'))
-        response.raise_for_status()
-
-    df = pd.DataFrame.from_dict(response.json()['value'])
+    # Follow next links until we have everything
+    values = []
+    url = search_url
+    while url is not None:
+        response = requests.get(url, params=params, timeout=TIMEOUT)
+        if response.status_code != 200:
+            if response.json().get('detail') is not None:
+                print(response.json().get('detail').get('message'))
+            response.raise_for_status()
+
+        values = values + response.json()['value']
+        url = response.json().get('@odata.nextLink')
+        params = None
+
+    return values
+
+def _stamp(ss: str) -> str:
+    # Fixed-width UTC timestamps so they compare as strings
+    return pd.Timestamp(ss).tz_convert(None).strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+def _ttl(wend: datetime, mode=None):
+    # How long a window is good for, given the mode and when it ends
+    ttl = CACHETTL.get(mode, CACHETTL['NRTI'])
+    late = timedelta(days=LATENCY.get(mode, max(LATENCY.values())))
+    if datetime.now() - late < wend:
+        ttl = min(ttl or CACHETTL['NRTI'], CACHETTL['NRTI'])
+    return ttl
+
+def _fresh(fetched: float, wend: datetime, ttl=None, mode=None) -> bool:
+    # Stricter of the TTL stored with the window and the caller's
+    ttls = [tt for tt in (ttl, _ttl(wend, mode)) if tt is not None]
+    return (len(ttls) == 0 or
+        datetime.now().timestamp() - fetched < min(ttls))
+
+def _catalogue(product: str, beg: datetime, end: datetime, mode=None,
+    refresh=False) -> list:
+    # Catalogue entries overlapping [beg, end), fetched a month at a time
+    # and kept in a local database between runs
+    makedirs(CACHEDIR, exist_ok=True)
+    db = sqlite3.connect(path.join(CACHEDIR, 'tropomi_catalogue.sqlite'),
+        timeout=60)
+    db.execute('CREATE TABLE IF NOT EXISTS orbits (product TEXT, ' +
+        'name TEXT PRIMARY KEY, id TEXT, start TEXT, stop TEXT, md5 TEXT)')
+
+    # Windows from older caches didn't record mode and TTL, so start over
+    cols = [rr[1] for rr in db.execute('PRAGMA table_info(windows)')]
+    if 0 < len(cols) and 'ttl' not in cols:
+        with db:
+            db.execute('DROP TABLE windows')
+    db.execute('CREATE TABLE IF NOT EXISTS windows (product TEXT, ' +
+        'beg TEXT, end TEXT, fetched REAL, mode TEXT, ttl REAL, ' +
+        'PRIMARY KEY (product, beg))')
+
+    mbeg = datetime(beg.year, beg.month, 1)
+    while mbeg < end:
+        mend = datetime(mbeg.year + mbeg.month//12, mbeg.month%12 + 1, 1)
+        wbeg = mbeg.strftime('%Y-%m-%dT%H:%M:%S.%f')
+        wend = mend.strftime('%Y-%m-%dT%H:%M:%S.%f')
+
+        row = db.execute('SELECT fetched, ttl FROM windows WHERE ' +
+            'product = ? AND beg = ?', (product, wbeg)).fetchone()
+        if refresh or row is None or not _fresh(row[0], mend, row[1], mode):
+            values = _query(product, mbeg, mend)
+            with db:
+                db.execute('DELETE FROM orbits WHERE product = ? AND ' +
+                    'stop > ? AND start < ?', (product, wbeg, wend))
+                db.executemany('INSERT OR REPLACE INTO orbits VALUES ' +
+                    '(?, ?, ?, ?, ?, ?)', [(product, vv['Name'], vv['Id'],
+                    _stamp(vv['ContentDate']['Start']),
+                    _stamp(vv['ContentDate']['End']),
+                    _md5(vv.get('Checksum'))) for vv in values])
+                db.execute('INSERT OR REPLACE INTO windows VALUES ' +
+                    '(?, ?, ?, ?, ?, ?)', (product, wbeg, wend,
+                    datetime.now().timestamp(), mode, _ttl(mend, mode)))
+        mbeg = mend
+
+    rows = db.execute('SELECT name, id, md5 FROM orbits WHERE product = ? ' +
+        'AND stop > ? AND start < ? ORDER BY start',
+        (product, beg.strftime('%Y-%m-%dT%H:%M:%S.%f'),
+        end.strftime('%Y-%m-%dT%H:%M:%S.%f'))).fetchall()
+    db.close()
+
+    return rows
+
+def get_orbits(var: str, today: datetime, mode=None, ver=DEFVER, ndays=1,
+    refresh=False):
+    product = 'L2__' + var.upper() + '_'*(6 - len(var))
+    tomrw = today + timedelta(days=ndays)
 
-    # Import features into dataframe and extract information
-    if df.empty:
-        return [], []
-    titles0 = df['Name'].values.tolist()
-    ids0 = df['Id'].values.tolist()
+    # Import catalogue entries and extract information
+    rows = _catalogue(product, today, tomrw, mode, refresh)
+    if len(rows) == 0:
+        return [], [], []
+    titles0 = [rr[0] for rr in rows]
+    ids0 = [rr[1] for rr in rows]
+    sums0 = [rr[2] for rr in rows]
 
     # Narrow results by mode and/or version
     if mode is not None:
@@ -106,58 +222,119 @@ def get_orbits(var: str, today: datetime, mode=None, ver=DEFVER):
     # Probably a more elegant way to apply regexs, but whatevs
     titles = []
     urls = []
+    sums = []
     for nn in range(len(titles0)):
         if (pattern1.search(titles0[nn]) is not None and
             pattern2.search(titles0[nn]) is not None):
             titles.append(titles0[nn])
-            urls.append('https://download.dataspace.copernicus.eu/odata/v1/' +
-                'Products(' + ids0[nn] + ')/$value')
-
-    return titles, urls
-
-def download(var: str, date: datetime, mode=None, ver=DEFVER, dirout=DEFOUT):
-    # Obtain token
-    xx = netrc()
-    username, _, password = xx.authenticators('identity.dataspace.copernicus.eu')
-    access_token, refresh_token = get_tokens(username, password)
+            urls.append(download_url + '(' + ids0[nn] + ')/$value')
+            sums.append(sums0[nn])
+
+    return titles, urls, sums
+
+def get_token_manager() -> dict:
+    # Authenticate once per process and share tokens between downloads, so
+    # long backfills don't log in again for every day
+    with TOKENS['lock']:
+        if TOKENS.get('access') is None:
+            xx = netrc()
+            username, _, password = xx.authenticators(
+                'identity.dataspace.copernicus.eu')
+            TOKENS['login'] = (username, password)
+            TOKENS['access'], TOKENS['refresh'] = get_tokens(username,
+                password)
+    return TOKENS
+
+def _refresh(tokens: dict, stale: str):
+    # Only refresh once when several threads fail with the same token; log
+    # in again if the refresh token has expired too
+    with tokens['lock']:
+        if tokens['access'] == stale:
+            try:
+                tokens['access'] = refresh_access_token(tokens['refresh'])
+            except Exception:
+                tokens['access'], tokens['refresh'] = get_tokens(
+                    *tokens['login'])
+
+class _Bearer(requests.auth.AuthBase):
+    # Bearer token from get_token_manager; when the server says it has
+    # expired (401/403), it's refreshed and the request sent again once
+    def __call__(self, request):
+        request.headers['Authorization'] = f"Bearer {TOKENS['access']}"
+        request.register_hook('response', self._expired)
+        return request
+
+    def _expired(self, response, **kwargs):
+        if response.status_code not in [401, 403]: return response
+
+        stale = response.request.headers['Authorization'].split()[-1]
+        _refresh(TOKENS, stale)
+        response.content
+        response.close()
+
+        prep = response.request.copy()
+        prep.deregister_hook('response', self._expired)
+        prep.headers['Authorization'] = f"Bearer {TOKENS['access']}"
+        again = response.connection.send(prep, **kwargs)
+        again.history.append(response)
+        again.request = prep
+        return again
+
+# Downloads go through fetch like every other acquirer (one session per
+# process, backoff, resuming, and host limits); this just adds the token
+AUTH = _Bearer()
+
+def _fetch(url: str, ff: str, checksum=None) -> str:
+    # Skip files that are already here (and check out, if we can tell)
+    if path.isfile(ff):
+        if checksum is None or _md5sum(ff).hexdigest() == checksum:
+            return ff
+        print(f'*** WARNING *** Checksum mismatch for {path.basename(ff)}, ' +
+            'downloading again')
+        remove(ff)
+
+    # Files are only moved into place once complete, but may not match
+    # the catalogue, so those get one more try
+    for _ in range(2):
+        if fetch.get(url, ff, mode='skip', auth=AUTH) is None:
+            raise Exception(f'Download of {path.basename(ff)} failed')
+        if checksum is None or _md5sum(ff).hexdigest() == checksum:
+            return ff
+        remove(ff)
+
+    raise Exception(f'Download of {path.basename(ff)} failed: checksum ' +
+        'mismatch')
+
+def download(var: str, date: datetime, mode=None, ver=DEFVER, dirout=DEFOUT,
+    jobs=DEFJOBS, refresh=False) -> int:
+    # Returns the number of files that failed to download
+
+    # Obtain token (if we don't already have one)
+    get_token_manager()
 
     # Perform OpenSearch query
-    titles, urls = get_orbits(var, date, mode, ver)
-
-    # Use OData to download files
-    ## Create a session and update headers
-    session = requests.Session()
-    headers = {'Authorization': f'Bearer {access_token}'}
-    session.headers.update(headers)
+    titles, urls, sums = get_orbits(var, date, mode, ver, refresh=refresh)
 
     ## Create download directory
     makedirs(dirout, exist_ok=True)
 
-    ## Loop over queries to extract
-    for url, title in zip(urls, titles):
-        # Get request
-        for nn in range(MAXTRIES):
-            try:
-                response = session.get(url, stream=True)
-                response.raise_for_status()
-                break
-            except requests.exceptions.RequestException as e:
-                access_token = refresh_access_token(refresh_token)
-                headers = {'Authorization': f'Bearer {access_token}'}
-                session.headers.update(headers)
-
-        # Path to save file
-        ff = path.join(dirout, title)
+    # Use OData to download files, a bounded number at a time
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        futures = [pool.submit(_fetch, url, path.join(dirout, title), md5)
+            for url, title, md5 in zip(urls, titles, sums)]
 
-        # Write to file
-        # This can throw a connection reset by peer error
-        # Need to wrap it somehow, maybe as above
-        with open(ff, 'wb') as fid:
-            fid.write(response.content)
+    # Report failures without giving up on the rest
+    nfail = 0
+    for title, future in zip(titles, futures):
+        try:
+            future.result()
+        except Exception as e:
+            print(f'*** WARNING *** {e}')
+            nfail = nfail + 1
 
-    print(f'Downloaded {len(titles)} files to {dirout}')
+    print(f'Downloaded {len(titles) - nfail} files to {dirout}')
 
-    return
+    return nfail
 
 
 def main():
@@ -173,12 +350,16 @@ def main():
         help='data version')
     parser.add_argument('-o', '--output', metavar='DIR', default=DEFOUT,
         help='output directory')
+    parser.add_argument('-j', '--jobs', type=int, default=DEFJOBS,
+        help='number of files to download at once')
+    parser.add_argument('-r', '--refresh', action='store_true',
+        help='refetch catalogue entries instead of using the cache')
 
     # Read args and translate to input vars for download
     args = vars(parser.parse_args())
     args['dirout'] = args.pop('output')
 
-    download(**args)
+    if 0 < download(**args): return 1
 
 
 if __name__ == '__main__':
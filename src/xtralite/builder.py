@@ -21,12 +21,248 @@ xtralite: Acquire, prepare, and translate constituent data for assimilation
 
 import sys
 from os import getenv
-from time import sleep
+from time import time, sleep
+from queue import Queue
+from threading import Thread
 from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+from concurrent.futures import ProcessPoolExecutor, Future, wait, \
+    FIRST_COMPLETED
 
 from xtralite import acquire, chunker
 
-def build(**xlargs):
+# Entries that don't pickle (modules and lambdas); setup rebuilds them
+NOPICKLE = ['obsmod', 'translate']
+
+# Sites the scheduler keeps within limits (see schedule), matched by the end
+# of host names: days acquired at once from the site, least time between
+# starting them (seconds), and connections allowed at once across all days
+# (None if only each day is limited, see fetch.HOSTJOBS); the connections
+# are split between the days being acquired as xlargs['dljobs']
+SITES = {
+    'gesdisc.eosdis.nasa.gov': (2, 0., None),	# GES DISC (ACOS, TROPESS)
+    'asdc.larc.nasa.gov':      (2, 0., None),	# LaRC ASDC (MOPITT)
+    'ceda.ac.uk':              (2, 0., None),	# CEDA (EuroGHG)
+    'iup.uni-bremen.de':       (1, 0., None),	# IUP Bremen (EuroGHG NRT)
+    'ipsl.fr':                 (1, 2., None),	# IPSL THREDDS (IASI)
+    'nies.go.jp':              (1, 0., None),	# NIES (GOSAT, GOSAT-2)
+    'dataspace.copernicus.eu': (1, 0., 4),	# CDSE (TROPOMI), per user
+}
+SITEDEF = (1, 0., None)
+
+# How much time each remote file covers (set by each module's setup), as a
+# date format that's the same for all the days in one file; the days a file
+# covers are acquired together (orbit files are found by day)
+GRANULES = {'orbit':'%Y%m%d', 'day':'%Y%m%d', 'month':'%Y%m', 'year':'%Y'}
+
+def _picklable(xlargs):
+    '''Strip arguments that can't be sent to worker processes'''
+    return {kk:vv for kk, vv in xlargs.items() if kk not in NOPICKLE}
+
+def _chunkdir(xlargs):
+    '''Set chunk directory from daily directory'''
+    chops = xlargs['daily'].rsplit('_daily', 1)
+    if len(chops) == 1: chops = chops + ['']
+    xlargs['chunk'] = '_chunks'.join(chops)
+
+    return xlargs
+
+def _granule(jdnow, xlargs):
+    '''Remote file (granule) that a day is acquired from'''
+    granule = xlargs.get('granule', 'day')
+    if granule not in GRANULES:
+        sys.stderr.write('*** ERROR *** Unsupported granule (%s)\n\n' %
+            granule)
+        sys.exit(2)
+
+    return jdnow.strftime(GRANULES[granule])
+
+def _acquire_day(jdnow, xlargs):
+    '''Acquire a single day (run in a worker process)'''
+    obsmod = acquire.getmod(xlargs['name'])
+    xlargs = obsmod.setup(jdnow, **xlargs)
+    xlargs = obsmod.acquire(jdnow, **xlargs)
+
+    return _picklable(xlargs)
+
+def _translate_day(jdnow, xlargs):
+    '''Translate a single day (run in a worker process)'''
+    obsmod = acquire.getmod(xlargs['name'])
+    xlargs = _chunkdir(obsmod.setup(jdnow, **xlargs))
+
+    return chunker.translate_day(jdnow, **xlargs)
+
+def _split_day(jdnow, xlargs):
+    '''Translate and split a single day (run in a worker process)'''
+    obsmod = acquire.getmod(xlargs['name'])
+    xlargs = _chunkdir(obsmod.setup(jdnow, **xlargs))
+
+    ftr = chunker.translate_day(jdnow, **xlargs)
+    if ftr is not None:
+        chunker.split(ftr, jdnow.strftime('%Y%m%d'), **xlargs)
+
+def _paste_day(jdnow, xlargs):
+    '''Paste windows ending on a single day (run in a worker process)'''
+    obsmod = acquire.getmod(xlargs['name'])
+    xlargs = _chunkdir(obsmod.setup(jdnow, **xlargs))
+
+    chunker.paste(jdnow.strftime('%Y%m%d'), **xlargs)
+
+def _submit(pool, fn, *args):
+    '''Submit to pool, returning a failed future if the pool is broken'''
+    try:
+        return pool.submit(fn, *args)
+    except Exception as err:
+        future = Future()
+        future.set_exception(err)
+        return future
+
+def _failed(stage, jdnow, err):
+    sys.stderr.write(('*** WARNING *** Failed to %s %s (%s)\n\n') %
+        (stage, jdnow.strftime('%Y-%m-%d'), repr(err)))
+
+def _result(jdnow, future, stage, default):
+    '''Get result of a stage, isolating failures to their day'''
+    try:
+        return future.result()
+    except (Exception, SystemExit) as err:
+        _failed(stage, jdnow, err)
+    return default
+
+def _chunk_day(jdnow, ftr, bits, xlargs):
+    '''Chunk a single day in this process (in order), isolating failures to
+    their day; returns the day's arguments, or those given if it failed'''
+    obsmod = xlargs['obsmod']
+    try:
+        xlnow = _chunkdir(obsmod.setup(jdnow, **xlargs))
+        chunker.chunk_day(jdnow, ftr, bits=bits, **xlnow)
+        return xlnow
+    except (Exception, SystemExit) as err:
+        _failed('chunk', jdnow, err)
+    return xlargs
+
+def _pipeline(days, **xlargs):
+    '''Run acquire, translate, and chunk stages concurrently'''
+    obsmod = xlargs['obsmod']
+    jobs  = max(xlargs.get('jobs',  1) or 1, 1)
+    depth = max(xlargs.get('depth', 0) or 0, 1)
+    codas = xlargs.get('codas', False)
+
+    # Sites that limit connections get no more days at once than that,
+    # and split the connections between them
+    nconn = _site(xlargs)[1][2]
+    nacq  = jobs
+    if nconn is not None:
+        nacq = min(jobs, nconn)
+        xlargs['dljobs'] = nconn // nacq
+    xlpick = _picklable(xlargs)
+
+    # Bounded queues between stages; a full queue blocks the stage before it
+    # (backpressure), so acquisition never gets more than jobs + depth days
+    # ahead of chunking
+    qacq = Queue(maxsize=jobs + depth)
+    qtrn = Queue(maxsize=depth)
+
+    def _feed(pool):
+        # Days sharing a granule share its acquisition
+        last = None
+        for jdnow in days:
+            if _granule(jdnow, xlargs) != last:
+                future = _submit(pool, _acquire_day, jdnow, xlpick)
+                last = _granule(jdnow, xlargs)
+            qacq.put((jdnow, future))
+        qacq.put(None)
+
+    def _relay(pool):
+        while True:
+            item = qacq.get()
+            if item is None: break
+            jdnow, future = item
+
+            # Translate what's there anyway to pick up what we can
+            xlnow = _result(jdnow, future, 'acquire', xlpick)
+            future = _submit(pool, _translate_day, jdnow, xlnow)
+            qtrn.put((jdnow, xlnow, future))
+        qtrn.put(None)
+
+    # Chunking stays in this process and in order since each day's chunks
+    # need the previous day's bits
+    with ProcessPoolExecutor(max_workers=nacq) as pacq, \
+        ProcessPoolExecutor(max_workers=jobs) as ptrn:
+        threads = [Thread(target=_feed, args=(pacq,), daemon=True)]
+        if codas:
+            threads.append(Thread(target=_relay, args=(ptrn,), daemon=True))
+        for tt in threads: tt.start()
+
+        qout = qtrn if codas else qacq
+        bits = {} if xlargs.get('inmem',False) else None
+        try:
+            while True:
+                item = qout.get()
+                if item is None: break
+
+                if not codas:
+                    jdnow, future = item
+                    xlargs = _result(jdnow, future, 'acquire', xlpick)
+                    continue
+
+                jdnow, xlnow, future = item
+                ftr = _result(jdnow, future, 'translate', None)
+                xlargs = _chunk_day(jdnow, ftr, bits, dict(xlnow,
+                    obsmod=obsmod))
+        finally:
+            if bits: chunker.flush(bits)
+
+        for tt in threads: tt.join()
+
+    return xlargs
+
+def _rechunk(days, **xlargs):
+    '''Chunk existing daily files, splitting days in parallel and pasting
+    each day once it and the day before are split'''
+    jobs = max(xlargs.get('jobs', 1) or 1, 1)
+    xlpick = _picklable(xlargs)
+
+    # Days before the first are whatever is on disk, so the first day only
+    # depends on itself; failed splits still count as done so their
+    # neighbors get pasted
+    jdfst  = days[0]
+    split  = set()
+    todo   = iter(days)
+    tasks  = {}
+    nsplit = 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        while True:
+            # Keep a few splits ahead of the workers, but not so many that
+            # bits pile up on disk before they're pasted
+            while nsplit < 2*jobs:
+                jdnow = next(todo, None)
+                if jdnow is None: break
+                tasks[_submit(pool, _split_day, jdnow, xlpick)] = \
+                    ('split', jdnow)
+                nsplit = nsplit + 1
+
+            if len(tasks) == 0: break
+
+            done, _ = wait(tasks, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, jdnow = tasks.pop(future)
+                _result(jdnow, future, stage, None)
+                if stage != 'split': continue
+
+                nsplit = nsplit - 1
+                split.add(jdnow)
+                for jdp in [jdnow, jdnow + timedelta(1)]:
+                    if jdp not in split: continue
+                    if jdp != jdfst and jdp - timedelta(1) not in split:
+                        continue
+                    tasks[_submit(pool, _paste_day, jdp, xlpick)] = \
+                        ('paste', jdp)
+
+    return xlargs
+
+def _setup(**xlargs):
+    '''Find the module for a product, check arguments, and set it up'''
     # Parse name to determine module
     name = xlargs.get('name', '')
     obsmod = acquire.getmod(name)
@@ -36,6 +272,13 @@ def build(**xlargs):
         sys.exit(2)
     xlargs['obsmod'] = obsmod
 
+    # Rechunking is chunking without acquiring
+    if xlargs.get('rechunk',False): xlargs['codas'] = True
+
+    # Check chunk windows before doing anything
+    if xlargs.get('codas',False):
+        chunker.windows(xlargs.get('windows', chunker.WINDEF))
+
     # To save time elsewhere
     xlargs['jdbeg'] = datetime.strptime(xlargs['beg'], '%Y-%m-%d')
     xlargs['jdend'] = datetime.strptime(xlargs['end'], '%Y-%m-%d')
@@ -45,7 +288,10 @@ def build(**xlargs):
     # Need to sort out defaults a little better
     xlargs['head'] = xlargs.get('head', 'data')
 
-    # Diagnostic output
+    return xlargs
+
+def _announce(xlargs):
+    '''Diagnostic output'''
     daily = xlargs.get('daily', '*')
     prep  = xlargs.get('prep',  '*')
     chunk = xlargs.get('chunk', '*')
@@ -55,9 +301,11 @@ def build(**xlargs):
     if xlargs.get('codas',False): print('Chunking files in ' + chunk)
     print('from ' + xlargs['beg'] + ' to ' + xlargs['end'])
     print('')
+
+def _countdown():
+    '''Last chance to kill'''
     print('OMP_NUM_THREADS = ' + getenv('OMP_NUM_THREADS'))
 
-    # Last chance to kill
     sys.stdout.write('\nIn ')
     sys.stdout.flush()
     for nn in range(5):
@@ -67,24 +315,25 @@ def build(**xlargs):
     sys.stdout.write('\n\n')
     sys.stdout.flush()
 
-    # Loop over variable and satellite if unspecified
-    xltame = dict(xlargs)
+def _expand(**xlargs):
+    '''Set up a product for each variable and satellite if unspecified'''
+    obsmod = xlargs['obsmod']
     if xlargs.get('var','*') == '*':
         sys.stderr.write('*** WARNING *** No variable specified\n\n')
         sys.stderr.write('Looping over: ' + ', '.join(obsmod.varlist) + '\n\n')
-        for var in obsmod.varlist:
-            xltame['var'] = var
-            build(**xltame)
-        return
+        return [pp for var in obsmod.varlist
+            for pp in _expand(**_setup(**dict(xlargs, var=var)))]
     if xlargs.get('sat','*') == '*':
         sys.stderr.write('*** WARNING *** No satellite specified\n\n')
         sys.stderr.write('Looping over: ' + ', '.join(obsmod.satlist) + '\n\n')
-        for sat in obsmod.satlist:
-            xltame['sat'] = sat
-            build(**xltame)
-        return
+        return [pp for sat in obsmod.satlist
+            for pp in _expand(**_setup(**dict(xlargs, sat=sat)))]
 
-    # Cut down on time & check range is valid
+    return [xlargs]
+
+def _clip(xlargs):
+    '''Cut down on time & check range is valid'''
+    obsmod = xlargs['obsmod']
     sat = xlargs.get('sat', '*')
     jdbeg = xlargs.get('jdbeg', datetime(1980, 1, 1))
     jdend = xlargs.get('jdend', datetime.now())
@@ -103,19 +352,230 @@ def build(**xlargs):
     xlargs['beg'] = jdbeg.strftime('%Y-%m-%d')
     xlargs['end'] = jdend.strftime('%Y-%m-%d')
 
+    return xlargs
+
+def _site(xlargs):
+    '''Site a product is downloaded from and its limits (see SITES)'''
+    obsmod = xlargs['obsmod']
+    if hasattr(obsmod, 'server'):
+        url = obsmod.server(**xlargs)
+    else:
+        url = getattr(obsmod, 'SERVE', '')
+
+    host = urlsplit(url).hostname or obsmod.__name__
+    for site in SITES:
+        if host == site or host.endswith('.' + site):
+            return site, SITES[site]
+
+    return host, SITEDEF
+
+def _interleave(products, **xlargs):
+    '''Acquire days of several products at once, taking turns between
+    products and keeping within each site's limits; days are translated as
+    they arrive and chunked in order for each product'''
+    jobs  = max(xlargs.get('jobs',  1) or 1, 1)
+    depth = max(xlargs.get('depth', 0) or 0, 1)
+    codas = xlargs.get('codas', False)
+
+    # Days at once (no more than --jobs or connections allowed) and seconds
+    # between starts by site
+    limit, every, active, last, conns = {}, {}, {}, {}, {}
+    prods = []
+    for xlnow in products:
+        site, (nsite, nsecs, nconn) = _site(xlnow)
+        limit[site]  = min(nsite, jobs, nconn or nsite)
+        every[site]  = nsecs
+        conns[site]  = nconn
+        active[site] = 0
+        last[site]   = 0.
+
+        ndays = (xlnow['jdend'] - xlnow['jdbeg']).days + 1
+        prods.append({'xlargs':xlnow, 'xlpick':_picklable(xlnow),
+            'site':site, 'todo':[xlnow['jdbeg'] + timedelta(nd)
+            for nd in range(ndays)], 'next':xlnow['jdbeg'], 'ahead':0,
+            'ready':{}, 'bits':{} if xlargs.get('inmem',False) else None})
+
+    # Each day gets its share of the site's connections
+    for pp in prods:
+        nconn = conns[pp['site']]
+        if nconn is not None:
+            pp['xlpick']['dljobs'] = nconn // limit[pp['site']]
+
+    for site in limit:
+        print('Acquiring at most %d day(s) at once from %s' %
+            (limit[site], site))
+    print('')
+
+    def _chunk(pp):
+        # Chunk whatever is next for a product, in order
+        obsmod = pp['xlargs']['obsmod']
+        while pp['next'] in pp['ready']:
+            jdnow = pp['next']
+            xlnow, ftr = pp['ready'].pop(jdnow)
+
+            _chunk_day(jdnow, ftr, pp['bits'], dict(xlnow, obsmod=obsmod))
+            pp['next'] = jdnow + timedelta(1)
+            pp['ahead'] = pp['ahead'] - 1
+
+    nwork = sum(limit.values())
+    tasks = {}
+    turn  = 0
+    with ProcessPoolExecutor(max_workers=nwork) as pacq, \
+        ProcessPoolExecutor(max_workers=nwork) as ptrn:
+        try:
+            while True:
+                # Start days taking turns between products, skipping those
+                # whose site is busy or was started on too recently, or that
+                # are too far ahead of chunking (backpressure)
+                wake = None
+                nn = 0
+                while nn < len(prods):
+                    pp = prods[(turn + nn) % len(prods)]
+                    site = pp['site']
+                    nn = nn + 1
+                    if (len(pp['todo']) == 0 or limit[site] <= active[site] or
+                        limit[site] + depth <= pp['ahead']): continue
+
+                    nwait = last[site] + every[site] - time()
+                    if 0 < nwait:
+                        wake = nwait if wake is None else min(wake, nwait)
+                        continue
+
+                    # Take every day from the same granule
+                    todo = pp['todo']
+                    days = [todo.pop(0)]
+                    while (0 < len(todo) and _granule(todo[0], pp['xlargs'])
+                        == _granule(days[0], pp['xlargs'])):
+                        days.append(todo.pop(0))
+
+                    future = _submit(pacq, _acquire_day, days[0],
+                        pp['xlpick'])
+                    tasks[future] = ('acquire', pp, days, None)
+                    active[site] = active[site] + 1
+                    last[site]   = time()
+                    pp['ahead']  = pp['ahead'] + len(days)
+
+                    # Next turn goes to the next product
+                    turn = (turn + nn) % len(prods)
+                    nn = 0
+
+                if len(tasks) == 0:
+                    if wake is None: break
+                    sleep(wake)
+                    continue
+
+                done, _ = wait(tasks, timeout=wake,
+                    return_when=FIRST_COMPLETED)
+
+                # Acquisitions are for a list of days (a granule)
+                for future in done:
+                    stage, pp, when, xlnow = tasks.pop(future)
+                    if stage == 'acquire':
+                        days = when
+                        active[pp['site']] = active[pp['site']] - 1
+
+                        # Translate what's there anyway to pick up what we can
+                        xlnow = _result(days[0], future, 'acquire',
+                            pp['xlpick'])
+                        if not codas:
+                            pp['ahead'] = pp['ahead'] - len(days)
+                            continue
+
+                        for jdnow in days:
+                            future = _submit(ptrn, _translate_day, jdnow,
+                                xlnow)
+                            tasks[future] = ('translate', pp, jdnow, xlnow)
+                        continue
+
+                    ftr = _result(when, future, 'translate', None)
+                    pp['ready'][when] = (xlnow, ftr)
+                    _chunk(pp)
+        finally:
+            for pp in prods:
+                if pp['bits']: chunker.flush(pp['bits'])
+
+    return products
+
+def schedule(names, **xlargs):
+    '''Build several products (names) together, interleaving their days
+    so every site they come from is kept as busy as it allows (see SITES)'''
+    products = []
+    for name in names:
+        xlnow = _setup(**dict(xlargs, name=name))
+        products = products + [_clip(pp) for pp in _expand(**xlnow)]
+
+    for xlnow in products:
+        print('*** ' + xlnow['name'] + ' ***')
+        _announce(xlnow)
+    _countdown()
+
+    # Rechunking doesn't download anything, so there's nothing to schedule
+    if xlargs.get('rechunk',False):
+        for xlnow in products:
+            ndays = (xlnow['jdend'] - xlnow['jdbeg']).days + 1
+            _rechunk([xlnow['jdbeg'] + timedelta(nd) for nd in range(ndays)],
+                **xlnow)
+        return products
+
+    return _interleave(products, **xlargs)
+
+def build(**xlargs):
+    # Several products (comma separated) are scheduled together
+    names = [nn.strip() for nn in xlargs.get('name', '').split(',')
+        if len(nn.strip()) != 0]
+    if 1 < len(names): return schedule(names, **xlargs)
+
+    xlargs = _setup(**xlargs)
+    obsmod = xlargs['obsmod']
+
+    _announce(xlargs)
+    _countdown()
+
+    # Loop over variable and satellite if unspecified
+    products = _expand(**xlargs)
+    if 1 < len(products):
+        for xlnow in products:
+            build(**xlnow)
+        return
+
+    xlargs = _clip(products[0])
+    jdbeg = xlargs['jdbeg']
+    jdend = xlargs['jdend']
+
     # Build and chunk (if requested)
     ndays = (jdend - jdbeg).days + 1
-    for nd in range(ndays):
-        jdnow = jdbeg + timedelta(nd)
+    if xlargs.get('rechunk',False):
+        days = [jdbeg + timedelta(nd) for nd in range(ndays)]
+        return _rechunk(days, **xlargs)
+
+    jobs  = xlargs.get('jobs',  1) or 1
+    depth = xlargs.get('depth', 0) or 0
+    if 1 < jobs or 0 < depth:
+        days = [jdbeg + timedelta(nd) for nd in range(ndays)]
+        return _pipeline(days, **xlargs)
 
-        xlargs = obsmod.setup(jdnow, **xlargs)
-        xlargs = obsmod.acquire(jdnow, **xlargs)
+    # Chunking in memory carries bits from one day to the next, writing
+    # what's left at the end for the next run
+    bits = {} if xlargs.get('inmem',False) else None
+    last = None
+    try:
+        for nd in range(ndays):
+            jdnow = jdbeg + timedelta(nd)
 
-        if xlargs.get('codas',False):
-            chops = xlargs['daily'].rsplit('_daily', 1)
-            if len(chops) == 1: chops = chops + ['']
-            xlargs['chunk'] = '_chunks'.join(chops)
+            # Acquire each granule once, on the first day it's needed
+            xlargs = obsmod.setup(jdnow, **xlargs)
+            if _granule(jdnow, xlargs) != last:
+                xlargs = obsmod.acquire(jdnow, **xlargs)
+                last = _granule(jdnow, xlargs)
 
-            chunker.chunk(jdnow, **xlargs)
+            # A day that fails to chunk doesn't stop the others
+            if xlargs.get('codas',False):
+                xlargs = _chunkdir(xlargs)
+                try:
+                    chunker.chunk(jdnow, bits=bits, **xlargs)
+                except (Exception, SystemExit) as err:
+                    _failed('chunk', jdnow, err)
+    finally:
+        if bits: chunker.flush(bits)
 
     return xlargs
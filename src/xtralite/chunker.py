@@ -12,6 +12,7 @@ Convert retrievals into xtralite and chunk for assimilation with CoDAS
 # * Improve filename handing to reduce/simplify calls to fhead, etc.
 #===============================================================================
 
+import sys
 from glob import glob
 from subprocess import call
 from os import path, makedirs
@@ -29,146 +30,226 @@ RMTMPS  = True
 TNAMEDEF  = 'time'
 RECDIMDEF = 'nsound'
 FTAILDEF  = '.nc'
+WINDEF    = '6:-3'				# 6-hour windows centered on 0, 6, 12, 18z
+DAYSEC    = 86400
 
-def split3hr(fin, date, **xlargs):
-    '''Split daily file into 3-hour chunks'''
-    LENHR = 10000
+def windows(spec=WINDEF):
+    '''Parse window specs into lengths and offsets (in seconds) and tags'''
+
+    # Windows are given as comma-separated length:offset pairs in hours;
+    # the window for time t covers [t + offset, t + offset + length)
+    wins = []
+    for ww in spec.split(','):
+        try:
+            hlen, hoff = [float(xx) for xx in ww.split(':')]
+        except ValueError:
+            hlen, hoff = 0., 0.
+        slen = int(round(3600*hlen))
+        soff = int(round(3600*hoff))
+
+        if (slen <= 0 or DAYSEC % slen != 0 or slen % 60 != 0 or
+            soff % 60 != 0):
+            sys.stderr.write(('*** ERROR *** Invalid window (%s); expected ' +
+                'length:offset in hours with a length that evenly divides ' +
+                'a day\n') % ww)
+            sys.exit(2)
+
+        # Chunk directory tag; default windows go in the chunk directory
+        tag = '_' + '%gh' % hlen
+        if 2*soff != -slen: tag = tag + '%+gh' % hoff
+        if [hlen, hoff] == [float(xx) for xx in WINDEF.split(':')]: tag = ''
+
+        wins.append((slen, soff, tag))
+
+    return wins
+
+def _ranges(slen, soff):
+    '''Window indices and their [beg, end) seconds of the day'''
+    kmin = -soff//slen
+    kmax = -((soff - DAYSEC)//slen) - 1
+    kk   = np.arange(kmin, kmax+1)
+
+    return kk, kk*slen + soff, (kk + 1)*slen + soff
+
+def _stamp(jdnow):
+    '''Date and time used in bit and chunk filenames'''
+    if jdnow.minute == 0: return jdnow.strftime('%Y%m%d_%H') + 'z'
+    return jdnow.strftime('%Y%m%d_%H%M') + 'z'
+
+def split(fin, date, bits=None, **xlargs):
+    '''Split daily file (or dataset) into bits, one for each window'''
 
     TNAME  = xlargs.get('tname',  TNAMEDEF)
     RECDIM = xlargs.get('recdim', RECDIMDEF)
     FTOUT  = xlargs.get('ftout',  FTAILDEF)
     FHOUT  = xlargs['fhout']
 
-    if VERBOSE: print('* Splitting   ' + path.basename(fin))
+    jdnow = datetime.strptime(date, '%Y%m%d')
+    wins  = windows(xlargs.get('windows', WINDEF))
 
-    # 1. Read time data
-    ds = xr.open_dataset(fin) 
-    itimes = ds[TNAME].values
-    ds.close()
+    # 1. Read data (once) unless it's already in memory
+    if isinstance(fin, xr.Dataset):
+        if VERBOSE: print('* Splitting   ' + date)
+        ds = fin
+    else:
+        if VERBOSE: print('* Splitting   ' + path.basename(fin))
+        with xr.open_dataset(fin) as ds:
+            ds.load()
 
-    nrec = len(itimes)
-    ihours = itimes//LENHR
-    chunks = np.zeros([8, 4], dtype=int)
+    # Convert hhmmss to seconds of the day
+    itimes = ds[TNAME].values
+    isecs  = 3600*(itimes//10000) + 60*(itimes//100 % 100) + itimes % 100
+
+    # 2. Compute indices to split at (times are assumed to be sorted) for
+    # all windows at once; bits are [n0, nF), and the first and last bits
+    # keep anything before/after the day
+    kwin = []
+    begs = []
+    for slen, soff, tag in wins:
+        kk, kbeg, kend = _ranges(slen, soff)
+        kwin.append(kk)
+        begs.append(np.maximum(kbeg, 0))
+    nall = np.searchsorted(isecs, np.concatenate([bb[1:] for bb in begs]))
 
-    # 2. Compute indices to split at
-    nF = -1
-    for ic in range(8):
-        n0 = nF + 1
-        it0 = 3*ic
-        itF = 3*(ic + 1)
+    # 3. Write split files
+    ibeg = 0
+    for (slen, soff, tag), kk, kbeg in zip(wins, kwin, begs):
+        nF = np.append(nall[ibeg:ibeg+kk.size-1], isecs.size)
+        n0 = np.concatenate(([0], nF[:-1]))
+        ibeg = ibeg + kk.size - 1
 
-        ## Assume failure
-        chunks[ic,:] = [it0, itF, -1, -1]
+        if DEBUG: print(np.stack((kk, kbeg, n0, nF), axis=1))
 
-        if nrec == n0: continue				# no records left to read?
-        if itF <= ihours[n0]: continue			# no records in the interval?
+        chunk = xlargs['chunk'] + tag
+        makedirs(chunk, exist_ok=True)
+        for ic in range(kk.size):
+            if nF[ic] <= n0[ic]: continue
 
-        ## Success! add em up
-        nF = n0
-        while nF < nrec-1:
-            if itF <= ihours[nF+1]: break
-            nF = nF + 1
+            jdbeg = jdnow + timedelta(seconds=int(kbeg[ic]))
+            ftmp  = path.join(chunk, FHOUT + _stamp(jdbeg) + '.bit' + FTOUT)
 
-        chunks[ic,:] = [it0, itF, n0, nF]
+            # Keep bits in memory if asked, using filename as key
+            if bits is not None:
+                bits[ftmp] = ds.isel({RECDIM:slice(n0[ic], nF[ic])})
+                continue
 
-    if DEBUG: print(chunks)
+            if VERBOSE: print('* Writing     ' + path.basename(ftmp))
 
-    # 3. Write split files
-    for ic in range(8):
-        vals = chunks[ic,:]
-        hour = str(vals[0]).zfill(2)
-        ftmp = path.join(xlargs['chunk'], FHOUT + date + '_' + hour + 'z' +
-            '.bit' + FTOUT)
+            ds.isel({RECDIM:slice(n0[ic], nF[ic])}).to_netcdf(ftmp)
 
-        if int(vals[2]) != -1:
-            if VERBOSE: print('* Writing     ' + path.basename(ftmp))
+    if isinstance(fin, xr.Dataset): return
 
-            ds = xr.open_dataset(fin)
-            ds = ds.isel({RECDIM:range(vals[2],vals[3]+1)})
-            # Pre-load to avoid hang?
-            ds.load().to_netcdf(ftmp)
-            ds.close()
+    ds.close()
 
     if RMTMPS: pout = call(['rm', fin])
 
-# This subroutine should receive the two the file strings fleft, frite, and
-# fout, which should be constructed in the chunker subroutine; that way we can
-# test it easily; the for loop should thus go to chunker too
-def paste6hr(date, dprv, **xlargs):
-    '''Paste 3-hour files together into 6-hour chunks'''
+def paste(date, bits=None, **xlargs):
+    '''Paste bits (in files or memory) together into windows ending on the
+    given day'''
 
-    TNAME  = xlargs.get('tname',  TNAMEDEF)
-    RECDIM = xlargs.get('recdim', RECDIMDEF)
     FTOUT  = xlargs.get('ftout',  FTAILDEF)
     FHOUT  = xlargs['fhout']
 
     jdnow = datetime.strptime(date, '%Y%m%d')
-
-    DIROUT = path.join(xlargs['chunk'], 'Y' + str(jdnow.year))
+    wins  = windows(xlargs.get('windows', WINDEF))
 
     if VERBOSE: print('---')
-    for nh in [-3, 3, 9, 15]:
-        jleft = jdnow + timedelta(hours=nh)
-        jrght = jdnow + timedelta(hours=nh+3)
-        dleft = jleft.strftime('%Y%m%d_%H') + 'z'
-        drght = jrght.strftime('%Y%m%d_%H') + 'z'
-
-        fleft = path.join(xlargs['chunk'], FHOUT + dleft + '.bit' + FTOUT)
-        frght = path.join(xlargs['chunk'], FHOUT + drght + '.bit' + FTOUT)
-        fout  = path.join(DIROUT,          FHOUT + drght          + FTOUT)
-
-        flist = []
-        if path.isfile(fleft): flist = flist + [fleft]
-        if path.isfile(frght): flist = flist + [frght]
-
-        if len(flist) == 0: continue
-
-        # Build input file list
-        inlist = []
-        for ff in flist:
-            ds = xr.open_dataset(ff)
-            for xx in ds.attrs['input_files'].split(', '):
-                if xx not in inlist: inlist.append(xx)
-            ds.close()
-        input_files = ', '.join(inlist)
-
-        # Only overwrite existing files if we are reprocessing
-        if not path.isfile(fout) or xlargs.get('repro',False):
-            if VERBOSE: print('* Writing     ' + path.basename(fout))
-
-            makedirs(DIROUT, exist_ok=True)
-
-            ## An unfortunate hack to keep RECDIM dtype constant
-            ds = xr.open_dataset(flist[0])
-            dtype = ds[RECDIM].dtype
-            ds.close()
-
-            ds = xr.open_mfdataset(flist, mask_and_scale=False,
-               combine='nested', concat_dim=RECDIM)
-            ds = ds.assign_coords({RECDIM: ds[RECDIM].values.astype(dtype)})
-            ds.attrs['input_files'] = input_files
-            ds.attrs['history'] = 'Created on ' + datetime.now().isoformat()
-            contact = 'Brad Weir <briardew@gmail.com>'
-            if 'contact' in ds.attrs:
-                contact = contact + ' / ' + ds.attrs['contact']
-            ds.attrs['contact'] = contact
-            ds.load().to_netcdf(fout)
-            ds.close()
-
-        if RMTMPS: pout = call(['rm', '-f', fleft, frght])
+    for slen, soff, tag in wins:
+        chunk = xlargs['chunk'] + tag
+
+        # Only windows that end on this day; the bits of a window that
+        # starts on the previous day are named by its start and midnight
+        kk, kbeg, kend = _ranges(slen, soff)
+        for kw, sbeg, send in zip(kk, kbeg, kend):
+            if DAYSEC < send: continue
+
+            jdout = jdnow + timedelta(seconds=int(kw*slen))
+            jdbeg = jdnow + timedelta(seconds=int(sbeg))
+
+            fbits = [path.join(chunk, FHOUT + _stamp(jdbeg) + '.bit' + FTOUT)]
+            if sbeg < 0:
+                fbits.append(path.join(chunk, FHOUT + _stamp(jdnow) + '.bit' +
+                    FTOUT))
+
+            dirout = path.join(chunk, 'Y' + str(jdout.year))
+            fout   = path.join(dirout, FHOUT + _stamp(jdout) + FTOUT)
+
+            _paste(fbits, fout, bits=bits, **xlargs)
     if VERBOSE: print('---')
 
-def chunk(jdnow, **xlargs):
-    '''Run chunker over the specified days'''
+def _paste(fbits, fout, bits=None, **xlargs):
+    '''Paste bits (fbits) together into a single chunk (fout)'''
+
+    RECDIM = xlargs.get('recdim', RECDIMDEF)
+
+    # Gather bits from memory first, then files (decode files when
+    # mixing with bits in memory since those are decoded)
+    decode = bits is not None
+    dslist = []
+    flist  = []
+    for ff in fbits:
+        if bits is not None and ff in bits:
+            dslist.append(bits.pop(ff))
+        elif path.isfile(ff):
+            with xr.open_dataset(ff, mask_and_scale=decode) as ds:
+                dslist.append(ds.load())
+            flist = flist + [ff]
+
+    if len(dslist) == 0: return
+
+    # Build input file list
+    inlist = []
+    for ds in dslist:
+        for xx in ds.attrs['input_files'].split(', '):
+            if xx not in inlist: inlist.append(xx)
+    input_files = ', '.join(inlist)
+
+    # Only overwrite existing files if we are reprocessing
+    if not path.isfile(fout) or xlargs.get('repro',False):
+        if VERBOSE: print('* Writing     ' + path.basename(fout))
+
+        makedirs(path.dirname(fout), exist_ok=True)
+
+        ## An unfortunate hack to keep RECDIM dtype constant
+        dtype = dslist[0][RECDIM].dtype
+
+        # Same options open_mfdataset uses for nested combines
+        ds = xr.concat(dslist, dim=RECDIM, data_vars='all',
+            coords='different', compat='no_conflicts', join='outer',
+            combine_attrs='override')
+        ds = ds.assign_coords({RECDIM: ds[RECDIM].values.astype(dtype)})
+        ds.attrs['input_files'] = input_files
+        ds.attrs['history'] = 'Created on ' + datetime.now().isoformat()
+        contact = 'Brad Weir <briardew@gmail.com>'
+        if 'contact' in ds.attrs:
+            contact = contact + ' / ' + ds.attrs['contact']
+        ds.attrs['contact'] = contact
+        ds.to_netcdf(fout)
+        ds.close()
+
+    if RMTMPS and len(flist) > 0: pout = call(['rm', '-f'] + flist)
+
+def finish(ds, ftr):
+    '''End a translation: write ds to ftr, or keep it in memory if there is
+    no output file (see translate_day); returns what translators return'''
+    if ftr is None:
+        ds.load()
+    else:
+        ds.to_netcdf(ftr)
+    ds.close()
+
+    return ds if ftr is None else None
+
+def translate_day(jdnow, **xlargs):
+    '''Translate the specified day, returning the translated filename
+    (or dataset if inmem is set)'''
 
     FHEAD = xlargs['fhead']
     FTAIL = xlargs.get('ftail', FTAILDEF)
     FHOUT = xlargs['fhout']
     FTOUT = xlargs.get('ftout', FTAILDEF)
     translate = xlargs['translate']
-
-    jdprv = jdnow + timedelta(-1)
-    jdnxt = jdnow + timedelta(+1)
+    inmem = xlargs.get('inmem', False)
 
     if xlargs['yrdigs'] == 2:
         yrget = str(jdnow.year-2000).zfill(2)
@@ -177,8 +258,6 @@ def chunk(jdnow, **xlargs):
 
     dget = yrget           + str(jdnow.month).zfill(2) + str(jdnow.day).zfill(2)
     dnow = str(jdnow.year) + str(jdnow.month).zfill(2) + str(jdnow.day).zfill(2)
-    dprv = str(jdprv.year) + str(jdprv.month).zfill(2) + str(jdprv.day).zfill(2)
-    dnxt = str(jdnxt.year) + str(jdnxt.month).zfill(2) + str(jdnxt.day).zfill(2)
 
     DIRIN = path.join(xlargs['prep'], 'Y' + str(jdnow.year))
 
@@ -199,15 +278,23 @@ def chunk(jdnow, **xlargs):
         # Convert data to standard format
         if VERBOSE:
             print('* Translating ' + path.basename(fin))
-            print('           to ' + path.basename(ftr))
+            if not inmem: print('           to ' + path.basename(ftr))
         try:
-            translate(fin, ftr)
+            if inmem:
+                # Decode like reopening the translated file would
+                ds = xr.decode_cf(translate(fin, None))
+            else:
+                translate(fin, ftr)
         except Exception as err:
             print(err)
             ftr = None
     else:
         ftr = None
 
+    if ftr is not None and inmem:
+        ds.attrs['input_files'] = path.basename(fin)
+        return ds
+
     if ftr is not None:
         # Set input filename
         with xr.open_dataset(ftr) as ds:
@@ -216,9 +303,38 @@ def chunk(jdnow, **xlargs):
         ds.to_netcdf(ftr)
         ds.close()
 
-        # Split day into 3-hour bits
-        split3hr(ftr, dnow, **xlargs)
+    return ftr
+
+def chunk_day(jdnow, ftr, bits=None, **xlargs):
+    '''Split and paste a translated day (ftr) into chunks
+
+    If bits is a dictionary, bits are kept there instead of written to
+    files; what's left after pasting goes on to the next day'''
+
+    dnow = str(jdnow.year) + str(jdnow.month).zfill(2) + str(jdnow.day).zfill(2)
+
+    # Split day into bits
+    if ftr is not None:
+        split(ftr, dnow, bits=bits, **xlargs)
 
-    # 3. Paste 3-hour bits together into 6-hour chunks
+    # 3. Paste bits together into chunks
     # (outside existence check to capture previous day's soundings)
-    paste6hr(dnow, dprv, **xlargs)
+    paste(dnow, bits=bits, **xlargs)
+
+    # Copy leftover bits so they don't hold on to the whole day
+    if bits is not None:
+        for ff in bits: bits[ff] = bits[ff].copy(deep=True)
+
+def chunk(jdnow, bits=None, **xlargs):
+    '''Run chunker over the specified days'''
+
+    ftr = translate_day(jdnow, **xlargs)
+    chunk_day(jdnow, ftr, bits=bits, **xlargs)
+
+def flush(bits):
+    '''Write bits still in memory to files so the next run can paste them'''
+
+    for ftmp in sorted(bits):
+        if VERBOSE: print('* Writing     ' + path.basename(ftmp))
+        bits[ftmp].to_netcdf(ftmp)
+    bits.clear()
@@ -15,6 +15,7 @@ import numpy as np
 # stop xarray from recasting coordinates
 #import xarray as xr
 from xtralite.patches import xarray as xr
+from xtralite import chunker
 
 def _generic(dd):
     dd = dd.rename({'xco2':'xco2_final', 'xco2_uncertainty':'xco2_uncert',
@@ -79,13 +80,12 @@ def gosat(fin, ftr):
 
     dd = dd.drop_vars(('gain'))
 
-    dd.to_netcdf(ftr)
+    dd = chunker.finish(dd, ftr)
     ## Safer this way, crashes other ways on some machines
-    dd.close()
     ddret.close()
     ddsnd.close()
 
-    return None
+    return dd
 
 def oco(fin, ftr):
     '''Translate ACOS XCO2 OCO retrievals to CoDAS format'''
@@ -103,10 +103,9 @@ def oco(fin, ftr):
     dd = dd.drop_vars(('vertex_latitude', 'vertex_longitude', 'vertices',
         'footprints', 'xco2_qf_simple_bitflag'), errors='ignore')
 
-    dd.to_netcdf(ftr)
+    dd = chunker.finish(dd, ftr)
     ## Safer this way, crashes other ways on some machines
-    dd.close()
     ddret.close()
     ddsnd.close()
 
-    return None
+    return dd
@@ -16,6 +16,7 @@ import pandas as pd
 # stop xarray from recasting coordinates
 #import xarray as xr
 from xtralite.patches import xarray as xr
+from xtralite import chunker
 
 RECDIM = 'nsound'
 
@@ -77,7 +78,4 @@ def translate(fin, ftr, var):
 
     dd = dd[['date', 'time', 'lat', 'lon', 'peavg', 'obs', 'uncert', 'isbad',
         'avgker', 'priorpro', 'priorobs']]
-    dd.to_netcdf(ftr)
-    dd.close()
-
-    return None
+    return chunker.finish(dd, ftr)
@@ -19,6 +19,7 @@ import pandas as pd
 # stop xarray from recasting coordinates
 #import xarray as xr
 from xtralite.patches import xarray as xr
+from xtralite import chunker
 
 def translate_co(fin, ftr):
     '''Translate IASI column CO retrievals to CoDAS format'''
@@ -95,10 +96,7 @@ def translate_co(fin, ftr):
         'CO_partial_column_profile', 'CO_partial_column_error',
         'CO_degrees_of_freedom', 'averaging_kernel_matrix'), errors='ignore')
 
-    dd.to_netcdf(ftr)
-    dd.close()
-
-    return None
+    return chunker.finish(dd, ftr)
 
 def translate_ch4(fin, ftr):
     '''Translate IASI column CH4 retrievals to CoDAS format'''
@@ -134,10 +132,7 @@ def translate_ch4(fin, ftr):
     dd = dd.drop_vars(('solar_zenith_angle', 'sensor_zenith_angle',
         'pressure_weight'))
 
-    dd.to_netcdf(ftr)
-    dd.close()
-
-    return None
+    return chunker.finish(dd, ftr)
 
 # Will need to depend on version for co
 translate = {
@@ -18,6 +18,7 @@ import netCDF4
 # stop xarray from recasting coordinates
 #import xarray as xr
 from xtralite.patches import xarray as xr
+from xtralite import chunker
 
 NEDGE = 11
 
@@ -153,9 +154,8 @@ def translate(fin, ftr, radtype):
     ds['avgker'].attrs['units'] = OBSUNIT + ' / ' + PROUNIT
 
     # Finish up
-    ds.to_netcdf(ftr)
-    ds.close()
+    ds = chunker.finish(ds, ftr)
     # Safer this way, crashes other ways on some machines
     dsdata.close()
 
-    return None
+    return ds
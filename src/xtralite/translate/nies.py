@@ -18,6 +18,7 @@ import netCDF4
 # stop xarray from recasting coordinates
 #import xarray as xr
 from xtralite.patches import xarray as xr
+from xtralite import chunker
 
 RECDIM = 'nsound'
 
@@ -162,9 +163,8 @@ def translate(fin, ftr, var, sat):
         'long_name':'prior profile'}))
 
     # Finish up
-    dd.to_netcdf(ftr)
-    dd.close()
+    dd = chunker.finish(dd, ftr)
     # Safer this way, crashes other ways on some machines
     ddata.close()
 
-    return None
+    return dd
@@ -15,6 +15,7 @@ import numpy as np
 # stop xarray from recasting coordinates
 #import xarray as xr
 from xtralite.patches import xarray as xr
+from xtralite import chunker
 
 PROUNIT = 'log10(mol/mol)'
 OBSUNIT = 'mol/m^2'
@@ -130,9 +131,8 @@ def translate(fin, ftr):
     ds = ds.drop(('datetime_utc', 'time_offset', 'year_fraction', 'pressure',
         'altitude', 'x'))
 
-    ds.to_netcdf(ftr)
+    ds = chunker.finish(ds, ftr)
     ## Safer this way, crashes other ways on some machines
-    ds.close()
     dsobs.close()
 
-    return None
+    return ds
@@ -17,6 +17,7 @@ import numpy as np
 # stop xarray from recasting coordinates
 #import xarray as xr
 from xtralite.patches import xarray as xr
+from xtralite import chunker
 
 FILLINT = -9999
 
@@ -89,10 +90,7 @@ def translate_co(fin, ftr):
     ds = ds.drop_vars('surface_altitude')
 
     ds = _generic_end(ds)
-    ds.to_netcdf(ftr)
-    ds.close()
-
-    return None
+    return chunker.finish(ds, ftr)
 
 def translate_ch4(fin, ftr):
     '''Translate TROPOMI column CH4 retrievals to CoDAS format'''
@@ -143,10 +141,7 @@ def translate_ch4(fin, ftr):
     ds = ds.drop_dims(['corner'], errors='ignore')
     ds = _generic_end(ds)
 
-    ds.to_netcdf(ftr)
-    ds.close()
-
-    return None
+    return chunker.finish(ds, ftr)
 
 def translate_hcho(fin, ftr):
     '''Translate TROPOMI column HCHO retrievals to CoDAS format'''
@@ -182,10 +177,7 @@ def translate_hcho(fin, ftr):
         'formaldehyde_tropospheric_vertical_column_trueness'])
 
     ds = _generic_end(ds)
-    ds.to_netcdf(ftr)
-    ds.close()
-
-    return None
+    return chunker.finish(ds, ftr)
 
 def translate_so2(fin, ftr):
     '''Translate TROPOMI column SO2 retrievals to CoDAS format'''
@@ -220,10 +212,7 @@ def translate_so2(fin, ftr):
         'tm5_constant_b', 'sulfurdioxide_total_vertical_column_trueness'])
 
     ds = _generic_end(ds)
-    ds.to_netcdf(ftr)
-    ds.close()
-
-    return None
+    return chunker.finish(ds, ftr)
 
 def translate_no2(fin, ftr):
     '''Translate TROPOMI column NO2 retrievals to CoDAS format'''
@@ -259,10 +248,7 @@ def translate_no2(fin, ftr):
         'tm5_constant_b', 'vertices'])
 
     ds = _generic_end(ds)
-    ds.to_netcdf(ftr)
-    ds.close()
-
-    return None
+    return chunker.finish(ds, ftr)
 
 def translate_o3(fin, ftr):
     '''Translate TROPOMI column O3 retrievals to CoDAS format'''
@@ -280,10 +266,7 @@ def translate_o3(fin, ftr):
     ds = ds.drop_vars('cloud_fraction_crb')
 
     ds = _generic_end(ds)
-    ds.to_netcdf(ftr)
-    ds.close()
-
-    return None
+    return chunker.finish(ds, ftr)
 
 translate = {
     'ch4':  translate_ch4,